@@ -34,7 +34,7 @@ CREATE TABLE sections (
   bpm VARCHAR(45) NOT NULL,
   bpm_ql VARCHAR(45) NOT NULL,
   PRIMARY KEY (id),
-  FOREIGN KEY (track_id) REFERENCES tracks(id)
+  FOREIGN KEY (track_id) REFERENCES tracks(id) ON DELETE CASCADE
 );
 
 --
@@ -47,7 +47,7 @@ CREATE TABLE phrases (
   phrase_length FLOAT NOT NULL,
   phrase_start_offset FLOAT NOT NULL,
   phrase_end_offset FLOAT NOT NULL,
-  FOREIGN KEY (section_id) REFERENCES sections(id)
+  FOREIGN KEY (section_id) REFERENCES sections(id) ON DELETE CASCADE
 );
 
 --
@@ -69,7 +69,7 @@ CREATE TABLE notes (
   nct INT NOT NULL,
   from_root_name VARCHAR(45) NOT NULL,
   from_root_pc INT NOT NULL,
-  FOREIGN KEY (section_id) REFERENCES sections(id)
+  FOREIGN KEY (section_id) REFERENCES sections(id) ON DELETE CASCADE
 );
 
 --
@@ -88,5 +88,15 @@ CREATE TABLE harmony (
   beat FLOAT NOT NULL,
   offset_ql FLOAT NOT NULL,
   duration_ql FLOAT NOT NULL,
-  FOREIGN KEY (section_id) REFERENCES sections(id)
+  FOREIGN KEY (section_id) REFERENCES sections(id) ON DELETE CASCADE
 );
+
+--
+-- Indexes on foreign keys, for per-section queries and deletes
+-- (kept in sync with INDEXES in musetable_db/const.py)
+--
+
+CREATE INDEX sections_track_id_idx ON sections (track_id);
+CREATE INDEX phrases_section_id_idx ON phrases (section_id);
+CREATE INDEX notes_section_id_offset_ql_idx ON notes (section_id, offset_ql);
+CREATE INDEX harmony_section_id_idx ON harmony (section_id);
@@ -0,0 +1,180 @@
+"""
+Admission control for preprocessing.  Every file gets a cost estimate before it's parsed,
+and files are admitted while the total cost in flight fits in a fixed capacity.  Others wait
+in a bounded FIFO queue, and requests that find the queue full are rejected with a 429, so
+a burst of large comprehensive requests can't grow memory without bound.
+
+Costs are weighted, so a huge score takes as much of the capacity as several small ones,
+instead of one slot like them.
+"""
+
+import asyncio
+import collections
+import contextlib
+import io
+import math
+import zipfile
+import zlib
+
+from const import ADMISSION_CAPACITY, ADMISSION_MAX_QUEUE, ADMISSION_QUEUE_TIMEOUT, MAX_MUSICXML_BYTES
+
+MEASURES_PER_COST_UNIT = 100  # a lead sheet of up to 100 measures costs 1
+BYTES_PER_COST_UNIT = 1024 * 1024  # of uncompressed MusicXML, for scores with many parts
+COMPREHENSIVE_COST_FACTOR = 4  # comprehensive runs take about 4 times as long as basic ones
+CHUNK_BYTES = 1024 * 1024
+
+
+class AdmissionRejected(Exception):
+    "Raised when a file can't be admitted.  retry_after is a hint, in seconds, and reason is 'queue_full' or 'timed_out'"
+
+    def __init__(self, message: str, retry_after: int, reason: str):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+def count_measures(xml_file, max_bytes: int = MAX_MUSICXML_BYTES) -> tuple:
+    """Return (number of <measure> elements, bytes read) of a MusicXML file object, reading it in
+    chunks.  Reading stops after max_bytes, since the parser rejects larger files anyway.
+    """
+    n_measures = 0
+    n_bytes = 0
+    tail = b''
+    while n_bytes < max_bytes:
+        chunk = xml_file.read(CHUNK_BYTES)
+        if not chunk:
+            break
+        n_bytes += len(chunk)
+        data = tail + chunk
+        n_measures += data.count(b'<measure ') + data.count(b'<measure>')  # not <measure-style> etc.
+        tail = data[-8:]  # shorter than the tags, so a tag split across chunks is counted once
+
+    return (n_measures, n_bytes)
+
+
+def estimate_cost(mxl_bytes: bytes, comprehensive: bool = False) -> float:
+    """
+    Estimate the cost of preprocessing a file, without parsing it: the larger of its measure
+    count and its uncompressed size, in cost units, times COMPREHENSIVE_COST_FACTOR for
+    comprehensive runs.  Files that aren't .mxl archives are counted as MusicXML.  Archives
+    that can't be decompressed cost the minimum, and the parser reports them.
+    """
+    n_measures = 0
+    n_bytes = 0
+    if zipfile.is_zipfile(io.BytesIO(mxl_bytes)):
+        try:
+            with zipfile.ZipFile(io.BytesIO(mxl_bytes)) as archive:
+                for info in archive.infolist():
+                    if info.filename.startswith('META-INF') or not info.filename.endswith(('.xml', '.musicxml')):
+                        continue
+                    with archive.open(info) as xml_file:
+                        member_measures, member_bytes = count_measures(xml_file, MAX_MUSICXML_BYTES - n_bytes)
+                    n_measures += member_measures
+                    n_bytes += member_bytes
+        # corrupted data, encrypted files and unsupported compression methods
+        except (zipfile.BadZipFile, zlib.error, EOFError, RuntimeError, NotImplementedError):
+            n_measures = 0
+            n_bytes = 0
+    else:
+        n_measures, n_bytes = count_measures(io.BytesIO(mxl_bytes))
+
+    cost = max(1.0, n_measures / MEASURES_PER_COST_UNIT, n_bytes / BYTES_PER_COST_UNIT)
+    if comprehensive:
+        cost *= COMPREHENSIVE_COST_FACTOR
+
+    return cost
+
+
+class AdmissionController:
+    """
+    AdmissionController admits work while the cost in flight fits in capacity, and queues up
+    to max_queue requests in FIFO order otherwise.  Costs larger than capacity are capped at
+    it, so a huge file runs alone instead of never running.
+    """
+
+    def __init__(self, capacity: float = ADMISSION_CAPACITY, max_queue: int = ADMISSION_MAX_QUEUE, queue_timeout: float = ADMISSION_QUEUE_TIMEOUT):
+        self.capacity = capacity
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0.0  # cost of admitted work
+        self.waiters = collections.deque()  # [cost, future], in arrival order
+        self.seconds_per_cost = 1.0  # moving average of run time per cost unit, for Retry-After
+        self.stats = {'admitted': 0, 'rejected': 0, 'timed_out': 0}
+
+
+    def get_retry_after(self) -> int:
+        "Estimate how many seconds it takes to work through the cost in flight and queued"
+        queued_cost = sum(cost for cost, _ in self.waiters)
+        return max(1, math.ceil(self.seconds_per_cost * (self.in_flight + queued_cost) / self.capacity))
+
+
+    def wake_waiters(self) -> None:
+        "Admit queued requests in order, for as long as the first one fits"
+        while self.waiters:
+            cost, future = self.waiters[0]
+            if future.done():  # cancelled while waiting
+                self.waiters.popleft()
+                continue
+            if self.in_flight + cost > self.capacity:
+                break
+            self.waiters.popleft()
+            self.in_flight += cost
+            future.set_result(None)
+
+        return None
+
+
+    async def acquire(self, cost: float, bounded: bool = True) -> float:
+        """Wait until cost can be admitted, and return the cost that was admitted.  Raises
+        AdmissionRejected if bounded and the queue is full, or if the wait is longer than
+        queue_timeout.
+        """
+        cost = min(cost, self.capacity)
+        if not self.waiters and self.in_flight + cost <= self.capacity:
+            self.in_flight += cost
+            self.stats['admitted'] += 1
+            return cost
+
+        if bounded and len(self.waiters) >= self.max_queue:
+            self.stats['rejected'] += 1
+            raise AdmissionRejected("too many requests are waiting to be processed", self.get_retry_after(), 'queue_full')
+
+        future = asyncio.get_running_loop().create_future()
+        waiter = [cost, future]
+        self.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=self.queue_timeout if bounded else None)
+        except asyncio.TimeoutError:
+            self.stats['timed_out'] += 1
+            self.remove_waiter(waiter)
+            raise AdmissionRejected("timed out waiting to be processed", self.get_retry_after(), 'timed_out')
+        except asyncio.CancelledError:
+            self.remove_waiter(waiter)
+            raise
+
+        self.stats['admitted'] += 1
+        return cost
+
+
+    def remove_waiter(self, waiter: list) -> None:
+        "Take a waiter out of the queue, giving its cost back if it was admitted in the meantime"
+        cost, future = waiter
+        if future.done() and not future.cancelled():
+            self.release(cost)
+        else:
+            future.cancel()
+            with contextlib.suppress(ValueError):
+                self.waiters.remove(waiter)
+            self.wake_waiters()
+
+        return None
+
+
+    def release(self, cost: float, seconds: float = None) -> None:
+        "Give back the cost of finished work.  seconds, the time it ran, updates the Retry-After estimate"
+        self.in_flight = max(0.0, self.in_flight - cost)
+        if seconds is not None and cost > 0:
+            self.seconds_per_cost = 0.9 * self.seconds_per_cost + 0.1 * seconds / cost
+        self.wake_waiters()
+
+        return None
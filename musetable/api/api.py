@@ -1,28 +1,609 @@
-from fastapi import FastAPI
-from preprocess import PreprocessXML
+import time
+import_start = time.perf_counter()  # to report how long importing the API takes
 
-app = FastAPI()
+import asyncio
+import functools
+import logging
+import queue
+from contextlib import asynccontextmanager
+from typing import List
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+from const import DATA_DICT, JOB_DB_PATH, MAX_BATCH_FILES, MAX_BATCH_UPLOAD_BYTES, PROFILING_ENABLED, STREAM_POLL_SECONDS
+from admission import AdmissionController, AdmissionRejected, estimate_cost
+from cache import ResultCache, etag_matches, make_cache_key, make_etag
+from metrics import PROMETHEUS_MEDIA_TYPE, Registry
+from jobs import JobManager, MemoryJobStore, SQLiteJobStore, get_job_timings
+from schema import make_arrow_table
+from upload import extract_files, read_body, read_upload_files
+from workers import VALIDATED_MESSAGE, WorkerPool, preprocess_job, profile_job, stream_job
+from serialize import (
+    ARROW_STREAM_MEDIA_TYPE, EVENT_STREAM_MEDIA_TYPE, JSON_MEDIA_TYPE, MIN_COMPRESS_BYTES, NDJSON_MEDIA_TYPE,
+    choose_encoding, compress, format_event, project_tables, to_arrow_ipc, to_json
+)
+
+logger = logging.getLogger(__name__)
+
+# music21 runs in worker processes, so the event loop stays free for other requests
+pool = WorkerPool()
+cache = ResultCache()
+admission = AdmissionController()
+
+
+async def run_job(job: dict, mxl_bytes: bytes) -> tuple:
+    "Process the file of a job queued by POST /jobs"
+    options = job['options']
+    # jobs are already limited by the number of consumers, so they wait for capacity instead of being rejected
+    return await get_result(options['comprehensive'], options['tables'], options['columns'], mxl_bytes=mxl_bytes, bounded=False)
+
+
+job_store = SQLiteJobStore(JOB_DB_PATH) if JOB_DB_PATH else MemoryJobStore()
+jobs = JobManager(job_store, run_job, n_consumers=pool.max_workers)
+
+# metrics exposed on /metrics
+registry = Registry()
+REQUESTS = registry.counter('musetable_requests_total', 'HTTP requests, by handler and status code', ['method', 'handler', 'status'])
+REQUEST_SECONDS = registry.histogram('musetable_request_duration_seconds', 'Time to answer HTTP requests, up to the response headers', ['method', 'handler'])
+STAGE_SECONDS = registry.histogram('musetable_stage_duration_seconds', 'Time spent in each preprocessing stage, and in serializing responses', ['stage'])
+PROCESSING_SECONDS = registry.counter('musetable_processing_seconds_total', 'Worker time spent preprocessing files')
+NOTES_PROCESSED = registry.counter('musetable_notes_processed_total', 'Notes and rests preprocessed')
+CHORDS_PROCESSED = registry.counter('musetable_chords_processed_total', 'Chords preprocessed')
+registry.counter('musetable_cache_memory_hits_total', 'Result cache hits in memory', func=lambda: cache.stats['memory_hits'])
+registry.counter('musetable_cache_disk_hits_total', 'Result cache hits on disk', func=lambda: cache.stats['disk_hits'])
+registry.counter('musetable_cache_misses_total', 'Result cache misses', func=lambda: cache.stats['misses'])
+registry.gauge('musetable_cache_hit_ratio', 'Result cache hits over lookups', func=lambda: cache.get_stats()['hit_rate'])
+registry.gauge('musetable_worker_jobs_in_flight', 'Jobs submitted to the worker pool and not finished', func=lambda: pool.n_pending)
+ADMISSION_WAIT_SECONDS = registry.histogram('musetable_admission_wait_seconds', 'Time files wait for admission before processing')
+registry.gauge('musetable_admission_cost_in_flight', 'Estimated cost of files being processed', func=lambda: admission.in_flight)
+registry.gauge('musetable_admission_queue_length', 'Files waiting for admission', func=lambda: len(admission.waiters))
+ADMISSION_REJECTED = registry.counter('musetable_admission_rejected_total', 'Files rejected by admission control, by reason', ['reason'])
+STARTUP_SECONDS = registry.gauge('musetable_startup_seconds', 'Time spent importing the API, and warming up the worker pool', ['phase'])
+registry.gauge('musetable_jobs_queued', 'Jobs of /jobs waiting for a consumer', func=lambda: job_store.count('queued'))
+
+
+startup = {}  # import and warm-up times, reported by /health
+startup['import_seconds'] = time.perf_counter() - import_start
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # warm every worker up before the server starts taking requests, so the first ones aren't slow
+    start = time.perf_counter()
+    startup['workers'] = await pool.warm_up()
+    await asyncio.get_running_loop().run_in_executor(None, pool.start_manager)  # for /preprocess/stream
+    startup['warm_up_seconds'] = time.perf_counter() - start
+    STARTUP_SECONDS.set(startup['import_seconds'], phase='import')
+    STARTUP_SECONDS.set(startup['warm_up_seconds'], phase='warm_up')
+    logger.info("API imported in %.2fs, %d workers warmed up in %.2fs", startup['import_seconds'], len(startup['workers']), startup['warm_up_seconds'])
+
+    jobs.start()
+    yield
+    await jobs.stop()
+    pool.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        endpoint = request.scope.get("endpoint")
+        handler = endpoint.__name__ if endpoint is not None else "none"
+        REQUESTS.inc(method=request.method, handler=handler, status=status)
+        REQUEST_SECONDS.observe(time.perf_counter() - start, method=request.method, handler=handler)
+
+
+@app.get("/health")
+def health():
+    "Answers once the worker pool has warmed up, with the startup times"
+    return {"status": "ok", "startup": startup}
+
+
+@app.get("/metrics")
+def metrics():
+    "Metrics of this API process, in the Prometheus text format"
+    return Response(content=registry.render(), media_type=PROMETHEUS_MEDIA_TYPE)
 
 @app.get("/")
 def root():
     return {"message": "API for musetable"}
 
 
+def check_projection(tables: List[str] = None, columns: List[str] = None) -> None:
+    "Raise a 400 error for unknown table or column names, before a file is processed for them"
+    try:
+        project_tables(DATA_DICT, tables, columns)
+    except KeyError as e:
+        raise HTTPException(status_code=400, detail=e.args[0])
+
+    return None
+
+
+def project_result(result: dict, tables: List[str] = None, columns: List[str] = None) -> dict:
+    "Keep only the requested tables and columns of a preprocess_job() result"
+    try:
+        data_dict = project_tables(result['data_dict'], tables, columns)
+    except KeyError as e:
+        raise HTTPException(status_code=400, detail=e.args[0])
+
+    return {**result, 'data_dict': data_dict}
+
+
+def negotiate(request: Request) -> tuple:
+    "Return (media_type, encoding) of the response, from the Accept and Accept-Encoding headers"
+    if ARROW_STREAM_MEDIA_TYPE in request.headers.get("accept", ""):
+        media_type = ARROW_STREAM_MEDIA_TYPE
+    else:
+        media_type = JSON_MEDIA_TYPE
+
+    return (media_type, choose_encoding(request.headers.get("accept-encoding", "")))
+
+
+def make_response(result: dict, media_type: str, encoding: str = None, etag: str = None) -> Response:
+    """
+    Serialize the tables of a preprocess_job() result, as Arrow IPC or JSON, and compress
+    the body with encoding (see negotiate()).
+    """
+    start = time.perf_counter()
+    data_dict = result['data_dict']
+    if media_type == ARROW_STREAM_MEDIA_TYPE:
+        body = to_arrow_ipc({
+            table: make_arrow_table(table, table_columns, result['data_type_dict'])
+            for table, table_columns in data_dict.items()
+        })
+    else:
+        body = to_json(data_dict)
+
+    headers = {"Vary": "Accept, Accept-Encoding"}
+    if etag is not None:
+        headers["ETag"] = etag
+    if encoding is not None and len(body) >= MIN_COMPRESS_BYTES:
+        body = compress(body, encoding)
+        headers["Content-Encoding"] = encoding
+    STAGE_SECONDS.observe(time.perf_counter() - start, stage='serialize')
+
+    return Response(content=body, media_type=media_type, headers=headers)
+
+
+async def run_preprocess(comprehensive: bool, mxl_filepath: str = None, mxl_bytes: bytes = None, profile: bool = False, event_queue=None) -> dict:
+    """
+    Run preprocess_job() in the worker pool, or profile_job() if profile is True, or
+    stream_job() if an event_queue is given.  Raises a 400 error for files that can't be read
+    as MusicXML, and a 504 error if the job takes longer than JOB_TIMEOUT.
+    """
+    if event_queue is not None:
+        job = functools.partial(stream_job, event_queue)
+    else:
+        job = profile_job if profile else preprocess_job
+    try:
+        result = await pool.run(job, comprehensive, mxl_filepath=mxl_filepath, mxl_bytes=mxl_bytes)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="preprocessing timed out")
+
+    for stage, seconds in result['timings'].items():
+        STAGE_SECONDS.observe(seconds, stage=stage)
+    PROCESSING_SECONDS.inc(sum(result['timings'].values()))
+    NOTES_PROCESSED.inc(result['n_notes'])
+    CHORDS_PROCESSED.inc(result['n_chords'])
+
+    return result
+
+
+async def run_admitted(comprehensive: bool, mxl_bytes: bytes, mxl_filepath: str = None, profile: bool = False, bounded: bool = True, event_queue=None, admitted: asyncio.Event = None) -> dict:
+    """
+    Run a file through admission control, then run_preprocess().  Raises a 429 error with a
+    Retry-After header if the admission queue is full, or if the file waited too long in it.
+    If mxl_filepath is given, the worker reads the file from there.  admitted is set once the
+    file has been admitted.
+    """
+    # estimating decompresses the file, so it runs in a thread
+    cost = await asyncio.get_running_loop().run_in_executor(None, estimate_cost, mxl_bytes, comprehensive)
+    start = time.perf_counter()
+    try:
+        cost = await admission.acquire(cost, bounded)
+    except AdmissionRejected as e:
+        ADMISSION_REJECTED.inc(reason=e.reason)
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    finally:
+        ADMISSION_WAIT_SECONDS.observe(time.perf_counter() - start)
+
+    if admitted is not None:
+        admitted.set()
+    start = time.perf_counter()
+    try:
+        if mxl_filepath is not None:
+            return await run_preprocess(comprehensive, mxl_filepath=mxl_filepath, profile=profile, event_queue=event_queue)
+        return await run_preprocess(comprehensive, mxl_bytes=mxl_bytes, profile=profile, event_queue=event_queue)
+    finally:
+        admission.release(cost, time.perf_counter() - start)
+
+
+async def get_result(comprehensive: bool, tables: List[str] = None, columns: List[str] = None, mxl_bytes: bytes = None, mxl_filepath: str = None, bounded: bool = True) -> tuple:
+    """
+    Return (cache_key, result) of a file, from the cache if it has been processed with the same
+    options before.  mxl_bytes is always needed for the cache key.  If mxl_filepath is given,
+    the worker reads the file from there.  bounded is passed to AdmissionController.acquire().
+    """
+    check_projection(tables, columns)
+    cache_key = make_cache_key(mxl_bytes, comprehensive, tables, columns)
+    result = await cache.get_async(cache_key)
+    if result is None:
+        result = await run_admitted(comprehensive, mxl_bytes, mxl_filepath=mxl_filepath, bounded=bounded)
+        if result['validation_message'] == VALIDATED_MESSAGE:
+            result = project_result(result, tables, columns)
+        await cache.set_async(cache_key, result)
+
+    return (cache_key, result)
+
+
+async def respond(request: Request, comprehensive: bool, tables: List[str] = None, columns: List[str] = None, mxl_bytes: bytes = None, mxl_filepath: str = None, profile: bool = False):
+    "Get the result of a file and turn it into a response"
+    if profile:
+        return await respond_profiled(comprehensive, tables, columns, mxl_bytes=mxl_bytes, mxl_filepath=mxl_filepath)
+
+    cache_key, result = await get_result(comprehensive, tables, columns, mxl_bytes=mxl_bytes, mxl_filepath=mxl_filepath)
+    return make_result_response(request, cache_key, result)
+
+
+async def respond_profiled(comprehensive: bool, tables: List[str] = None, columns: List[str] = None, mxl_bytes: bytes = None, mxl_filepath: str = None) -> Response:
+    """
+    Process a file under cProfile, bypassing the cache, and return a JSON response with the
+    data, the stage timings and the profile report.  Profiling must be enabled with
+    MUSETABLE_PROFILING_ENABLED, since it slows the request down and exposes server paths.
+    """
+    if not PROFILING_ENABLED:
+        raise HTTPException(status_code=403, detail="profiling is disabled on this server")
+    check_projection(tables, columns)
+
+    result = await run_admitted(comprehensive, mxl_bytes, mxl_filepath=mxl_filepath, profile=True)
+    if result['validation_message'] == VALIDATED_MESSAGE:
+        result = project_result(result, tables, columns)
+    content = {key: result[key] for key in ['data_dict', 'validation_message', 'timings', 'profile']}
+
+    return Response(content=to_json(content), media_type=JSON_MEDIA_TYPE)
+
+
+def make_result_response(request: Request, cache_key: str, result: dict):
+    "Turn a result into a response, or a 304 if the client's copy is current"
+    media_type, encoding = negotiate(request)
+    if result['validation_message'] != VALIDATED_MESSAGE:
+        return {"error message": result['validation_message']}
+
+    etag = make_etag(cache_key, media_type, encoding)
+    if etag_matches(request.headers.get("if-none-match", ""), etag):
+        return Response(status_code=304, headers={"ETag": etag, "Vary": "Accept, Accept-Encoding"})
+    return make_response(result, media_type, encoding, etag)
+
+
+def read_bytes(filepath: str) -> bytes:
+    "Read a whole file.  Blocks, see read_file()"
+    with open(filepath, 'rb') as file:
+        return file.read()
+
+
+async def read_file(mxl_filepath: str) -> bytes:
+    "Read a file from the server's filesystem in a thread, raising a 400 error if it can't be read"
+    try:
+        return await asyncio.get_running_loop().run_in_executor(None, read_bytes, mxl_filepath)
+    except OSError as e:
+        raise HTTPException(status_code=400, detail=f"could not read {mxl_filepath}: {e.strerror}")
+
+
 @app.post("/preprocess")
-def preprocess(mxl_filepath: str, comprehensive: bool = False):
+async def preprocess(
+    request: Request,
+    mxl_filepath: str,
+    comprehensive: bool = False,
+    tables: List[str] = Query(None),
+    columns: List[str] = Query(None),
+    profile: bool = False,
+):
     """
     Loads and transforms a music xml file into a dictionary, and validates the data.
     If validation passes, returns the dictionary.
     If validation fails, returns the error message.
 
+    The response is JSON, or Arrow IPC streams if the request's Accept header is
+    'application/vnd.apache.arrow.stream' (see serialize.py).  Responses are compressed
+    with zstd or gzip when the Accept-Encoding header allows it.
+
+    Results are cached by file contents and options (see cache.py).  Responses carry an
+    ETag, and a request whose If-None-Match header matches it gets a 304.
+
     Args
     - mxl_filepath: filepath to music mxl file
     - comprehensive: If False, creates dict with 6 basic keys.  If True, dict has 16 keys.
+    - tables: optional, only return these tables
+    - columns: optional, only return these columns, as 'table.column', e.g. 'notes.note_id'
+    - profile: optional, if the server has MUSETABLE_PROFILING_ENABLED set, bypass the cache and
+      return {"data_dict", "validation_message", "timings", "profile"}, where profile lists the
+      functions with the highest cumulative time, music21's included
+    """
+    mxl_bytes = await read_file(mxl_filepath)
+    return await respond(request, comprehensive, tables, columns, mxl_bytes=mxl_bytes, mxl_filepath=mxl_filepath, profile=profile)
+
+
+@app.post("/preprocess/upload")
+async def preprocess_upload(
+    request: Request,
+    comprehensive: bool = False,
+    tables: List[str] = Query(None),
+    columns: List[str] = Query(None),
+    profile: bool = False,
+):
+    """
+    Same as /preprocess, but the .mxl file is uploaded in the request body instead of read
+    from the server's filesystem.  Send the file either as the raw request body, or as a
+    multipart/form-data file field.  Bodies larger than MAX_UPLOAD_BYTES are rejected.
+
+    Args
+    - comprehensive: If False, creates dict with 6 basic keys.  If True, dict has 16 keys.
+    - tables: optional, only return these tables
+    - columns: optional, only return these columns, as 'table.column', e.g. 'notes.note_id'
+    - profile: optional, see /preprocess
+    """
+    _, mxl_bytes = (await read_upload_files(request))[0]
+    return await respond(request, comprehensive, tables, columns, mxl_bytes=mxl_bytes, profile=profile)
+
+
+async def stream_events(comprehensive: bool, tables: List[str] = None, columns: List[str] = None, mxl_bytes: bytes = None, mxl_filepath: str = None):
+    """
+    Process a file, yielding server-sent events as it goes: 'stage' and 'progress' events from
+    the worker, a 'table' event with the columns of each requested table as soon as it's
+    complete, then 'done' with the validation message and timings, or 'error'.
+    """
+    cache_key = make_cache_key(mxl_bytes, comprehensive, tables, columns)
+    result = await cache.get_async(cache_key)
+    if result is None:
+        loop = asyncio.get_running_loop()
+        event_queue = await loop.run_in_executor(None, pool.make_queue)  # a call to the manager process
+        admitted = asyncio.Event()
+        task = asyncio.ensure_future(run_admitted(comprehensive, mxl_bytes, mxl_filepath=mxl_filepath, event_queue=event_queue, admitted=admitted))
+        admitted_waiter = asyncio.ensure_future(admitted.wait())
+        try:
+            # nothing is put on the queue before the file is admitted
+            await asyncio.wait([task, admitted_waiter], return_when=asyncio.FIRST_COMPLETED)
+
+            # poll without blocking, so open streams don't hold threads of the default executor
+            while True:
+                try:
+                    item = event_queue.get_nowait()
+                except queue.Empty:
+                    if task.done():  # the job failed before it started, or its worker died
+                        break
+                    await asyncio.sleep(STREAM_POLL_SECONDS)
+                    continue
+                if item is None:
+                    break
+
+                event, fields = item
+                if event == 'table':
+                    table = fields['table']
+                    if tables and table not in tables:
+                        continue
+                    table_columns = [column for column in columns or [] if column.startswith(f"{table}.")]
+                    fields = {'table': table, 'columns': project_tables({table: fields['columns']}, None, table_columns)[table]}
+                yield format_event(event, fields)
+
+            result = await task
+        except HTTPException as e:
+            yield format_event('error', {'status_code': e.status_code, 'detail': e.detail})
+            return
+        except Exception as e:  # the parser failed on the file
+            yield format_event('error', {'status_code': 500, 'detail': f"{type(e).__name__}: {e}"})
+            return
+        finally:
+            task.cancel()
+            admitted_waiter.cancel()
+
+        if result['validation_message'] == VALIDATED_MESSAGE:
+            result = project_result(result, tables, columns)
+        await cache.set_async(cache_key, result)
+    else:
+        # send cached tables all at once
+        if result['validation_message'] == VALIDATED_MESSAGE:
+            for table, table_columns in result['data_dict'].items():
+                yield format_event('table', {'table': table, 'columns': table_columns})
+
+    yield format_event('done', {'validation_message': result['validation_message'], 'timings': result.get('timings', {})})
+
+
+@app.post("/preprocess/stream")
+async def preprocess_stream(
+    request: Request,
+    mxl_filepath: str = None,
+    comprehensive: bool = False,
+    tables: List[str] = Query(None),
+    columns: List[str] = Query(None),
+):
+    """
+    Same as /preprocess, but the response is a stream of server-sent events, so clients can
+    show progress and render tables as soon as they are ready, e.g. notes and chords while
+    notes_details is still computing.  The file is read from mxl_filepath if it's given, and
+    uploaded like in /preprocess/upload otherwise.
+
+    Events
+    - stage: {"stage", "seconds"}, when a stage of PreprocessXML finishes
+    - progress: {"stage": "input_loop", "pct"}, percentage of score elements processed
+    - table: {"table", "columns"}, the data of a complete table
+    - done: {"validation_message", "timings"}.  Tables are only validated at the end, so
+      discard them if validation_message isn't "all values validated!"
+    - error: {"status_code", "detail"}
+    """
+    if mxl_filepath is not None:
+        mxl_bytes = await read_file(mxl_filepath)
+    else:
+        _, mxl_bytes = (await read_upload_files(request))[0]
+
+    check_projection(tables, columns)  # before the response starts
+
+    return StreamingResponse(
+        stream_events(comprehensive, tables, columns, mxl_bytes=mxl_bytes, mxl_filepath=mxl_filepath),
+        media_type=EVENT_STREAM_MEDIA_TYPE,
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def process_batch_item(
+    index: int,
+    filename: str,
+    semaphore: asyncio.Semaphore,
+    comprehensive: bool,
+    tables: List[str] = None,
+    columns: List[str] = None,
+    mxl_bytes: bytes = None,
+    mxl_filepath: str = None,
+) -> dict:
+    """
+    Process one file of a batch, and return its NDJSON record.  Failures are recorded in the
+    record instead of raised, so one bad file doesn't fail the batch.
+    """
+    record = {"index": index, "filename": filename}
+    try:
+        async with semaphore:  # a batch keeps at most one file per worker in flight, so it doesn't fill the admission queue
+            if mxl_bytes is None:
+                mxl_bytes = await read_file(mxl_filepath)
+            _, result = await get_result(comprehensive, tables, columns, mxl_bytes=mxl_bytes, mxl_filepath=mxl_filepath)
+    except HTTPException as e:
+        return {**record, "status": "error", "status_code": e.status_code, "error": e.detail}
+    except Exception as e:
+        return {**record, "status": "error", "status_code": 500, "error": f"{type(e).__name__}: {e}"}
+
+    if result['validation_message'] != VALIDATED_MESSAGE:
+        return {**record, "status": "invalid", "error": result['validation_message']}
+    return {**record, "status": "ok", "data": result['data_dict']}
+
+
+async def stream_batch(items: List[dict], comprehensive: bool, tables: List[str] = None, columns: List[str] = None):
+    """
+    Process batch items concurrently, yielding one NDJSON line per file as soon as it finishes.
+    Files wait for a free worker in WorkerPool.run(), shared with every other request of the
+    process, so JOB_TIMEOUT only counts processing.
+    """
+    semaphore = asyncio.Semaphore(pool.max_workers)
+    tasks = [
+        asyncio.ensure_future(process_batch_item(index, semaphore=semaphore, comprehensive=comprehensive, tables=tables, columns=columns, **item))
+        for index, item in enumerate(items)
+    ]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield to_json(await next_done) + b"\n"
+    finally:
+        for task in tasks:  # the client went away, don't keep the pool busy for it
+            task.cancel()
+
+
+@app.post("/preprocess/batch")
+async def preprocess_batch(
+    request: Request,
+    mxl_filepaths: List[str] = Query(None),
+    comprehensive: bool = False,
+    tables: List[str] = Query(None),
+    columns: List[str] = Query(None),
+):
+    """
+    Process many files at once, on all workers of the pool.  Files can be uploaded as
+    multipart/form-data file fields, listed as mxl_filepaths on the server, or both.
+
+    The response is NDJSON, streamed one line per file in the order they finish:
+    {"index": ..., "filename": ..., "status": "ok", "data": {...}}.  Files that fail have
+    status "error" (with status_code and error) or "invalid" (with the validation message),
+    and don't affect the other files.
+
+    Args
+    - mxl_filepaths: optional, filepaths to music mxl files
+    - comprehensive: If False, creates dicts with 6 basic keys.  If True, dicts have 16 keys.
+    - tables: optional, only return these tables
+    - columns: optional, only return these columns, as 'table.column', e.g. 'notes.note_id'
+    """
+    body = await read_body(request, MAX_BATCH_UPLOAD_BYTES)
+    items = [{"filename": filename, "mxl_bytes": mxl_bytes} for filename, mxl_bytes in extract_files(body, request.headers.get("content-type", ""))]
+    items += [{"filename": mxl_filepath, "mxl_filepath": mxl_filepath} for mxl_filepath in mxl_filepaths or []]
+
+    if len(items) == 0:
+        raise HTTPException(status_code=400, detail="no files were uploaded or listed")
+    if len(items) > MAX_BATCH_FILES:
+        raise HTTPException(status_code=413, detail=f"batches are limited to {MAX_BATCH_FILES} files")
+
+    return StreamingResponse(stream_batch(items, comprehensive, tables, columns), media_type=NDJSON_MEDIA_TYPE)
+
+
+@app.post("/jobs", status_code=202)
+async def create_job(
+    request: Request,
+    mxl_filepath: str = None,
+    comprehensive: bool = False,
+    tables: List[str] = Query(None),
+    columns: List[str] = Query(None),
+):
+    """
+    Queue a preprocessing job and return its id straight away, for files that take longer
+    than a request is allowed to.  The file is read from mxl_filepath if it's given, and
+    uploaded like in /preprocess/upload otherwise.  Poll GET /jobs/{job_id} for its status,
+    and fetch its output from GET /jobs/{job_id}/result.
+
+    Args
+    - mxl_filepath: optional, filepath to music mxl file
+    - comprehensive: If False, creates dict with 6 basic keys.  If True, dict has 16 keys.
+    - tables: optional, only return these tables
+    - columns: optional, only return these columns, as 'table.column', e.g. 'notes.note_id'
+    """
+    check_projection(tables, columns)  # rather than failing the job once it has been processed
+    if mxl_filepath is not None:
+        filename, mxl_bytes = mxl_filepath, await read_file(mxl_filepath)
+    else:
+        filename, mxl_bytes = (await read_upload_files(request))[0]
+
+    options = {"comprehensive": comprehensive, "tables": tables, "columns": columns}
+    job = await jobs.submit(mxl_bytes, filename, options)
+    status_url = f"/jobs/{job['job_id']}"
+    return JSONResponse(
+        status_code=202,
+        content={"job_id": job['job_id'], "status": job['status'], "status_url": status_url, "result_url": f"{status_url}/result"},
+        headers={"Location": status_url},
+    )
+
+
+def get_job(job_id: str) -> dict:
+    "Return a job's record, raising a 404 error if there's no such job"
+    job = job_store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"no job {job_id}")
+    return job
+
+
+@app.get("/jobs/{job_id}")
+def job_status(job_id: str):
+    "Status, stage and timings of a job"
+    job = get_job(job_id)
+    return {**job, **get_job_timings(job)}
+
+
+@app.get("/jobs/{job_id}/result")
+def job_result(request: Request, job_id: str):
     """
-    preproc = PreprocessXML()
-    preproc.load_data(mxl_filepath, comprehensive)
-    preproc.input_all()
-    validation_message = preproc.validate_input()
-    if validation_message == "all values validated!":
-        return preproc.data_dict
-    return {"error message": validation_message}
+    Output of a finished job, in the same formats as /preprocess.  Returns a 409 error if the
+    job hasn't finished, and the job's error if it failed.
+    """
+    job = get_job(job_id)
+    if job['status'] == 'failed':
+        raise HTTPException(status_code=job['status_code'], detail=job['error'])
+    if job['status'] != 'done':
+        raise HTTPException(status_code=409, detail=f"job {job_id} is {job['status']}")
+
+    return make_result_response(request, job['cache_key'], job_store.get_result(job_id))
+
+
+@app.get("/cache")
+def cache_stats():
+    "Hit and miss counts and sizes of the result cache"
+    return cache.get_stats()
@@ -0,0 +1,264 @@
+"""
+Cache preprocessing results, so the same score isn't analysed twice.
+
+Results are keyed by the sha256 of the file's bytes, the comprehensive flag, the requested
+tables and columns, and the engine version (a hash of the parser's source files), so
+editing preprocess.py invalidates every cached result.  There are two tiers: an LRU dict
+in each API process, and an optional SQLite file shared by every uvicorn worker on the
+machine (set MUSETABLE_CACHE_DB_PATH to enable it), which keeps the newest
+MUSETABLE_CACHE_DB_MAX_ITEMS results.
+"""
+
+import asyncio
+import functools
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Optional, Sequence
+
+from const import CACHE_MAX_ITEMS, CACHE_DB_PATH, CACHE_DB_MAX_ITEMS
+
+my_path = os.path.dirname(os.path.abspath(__file__))
+ENGINE_FILES = ['preprocess.py', 'const.py', 'schema.py']  # files whose changes change results
+
+
+def get_engine_version(filenames: Sequence[str] = ENGINE_FILES) -> str:
+    "Hash the source files of the parser, so results are recomputed whenever they change"
+    engine_hash = hashlib.sha256()
+    for filename in filenames:
+        with open(os.path.join(my_path, filename), 'rb') as file:
+            engine_hash.update(file.read())
+
+    return engine_hash.hexdigest()[:16]
+
+
+ENGINE_VERSION = get_engine_version()
+
+
+def make_cache_key(mxl_bytes: bytes, comprehensive: bool, tables: Sequence[str] = None, columns: Sequence[str] = None, engine_version: str = ENGINE_VERSION) -> str:
+    "Make a cache key from a file's contents and the options it's processed with"
+    key = hashlib.sha256()
+    key.update(hashlib.sha256(mxl_bytes).digest())
+    key.update(repr((
+        bool(comprehensive),
+        sorted(set(tables or [])),
+        sorted(set(columns or [])),
+        engine_version,
+    )).encode())
+
+    return key.hexdigest()
+
+
+def make_etag(cache_key: str, media_type: str, encoding: Optional[str]) -> str:
+    "Make the ETag of one representation (media type and content encoding) of a cached result"
+    representation = hashlib.sha256(f"{cache_key}:{media_type}:{encoding}".encode()).hexdigest()[:32]
+    return f'"{representation}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    "Check an If-None-Match header against an ETag"
+    if if_none_match.strip() == '*':
+        return True
+    candidates = [candidate.strip() for candidate in if_none_match.split(',')]
+    return etag in candidates or f"W/{etag}" in candidates
+
+
+async def run_in_thread(func, *args):
+    "Run blocking I/O in the event loop's default thread pool (asyncio.to_thread needs Python 3.9)"
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args))
+
+
+class LRUCache:
+    "LRUCache keeps up to max_items values in memory, dropping the least recently used first"
+
+    def __init__(self, max_items: int = CACHE_MAX_ITEMS):
+        self.max_items = max_items
+        self.items = OrderedDict()
+
+
+    def get(self, key: str):
+        if key not in self.items:
+            return None
+        self.items.move_to_end(key)
+        return self.items[key]
+
+
+    def set(self, key: str, value) -> None:
+        if self.max_items <= 0:
+            return None
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_items:
+            self.items.popitem(last=False)
+
+        return None
+
+
+    def clear(self) -> None:
+        self.items.clear()
+        return None
+
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+
+class SQLiteCache:
+    """SQLiteCache stores pickled, zlib-compressed values in a SQLite file, which can be shared
+    by several processes.  Past max_items values, the oldest are evicted.  A connection is
+    opened per call, so instances are safe to use from any thread.
+    """
+
+    def __init__(self, db_path: str, max_items: int = CACHE_DB_MAX_ITEMS):
+        self.db_path = db_path
+        self.max_items = max_items
+        with self.connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")  # readers don't block the writer
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value BLOB NOT NULL, created_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS results_created_at ON results (created_at)")
+
+
+    def connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=30)
+
+
+    def get(self, key: str):
+        conn = self.connect()
+        try:
+            row = conn.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+        finally:
+            conn.close()
+
+        return None if row is None else pickle.loads(zlib.decompress(row[0]))
+
+
+    def set(self, key: str, value) -> None:
+        blob = zlib.compress(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO results (key, value, created_at) VALUES (?, ?, ?)",
+                    (key, blob, time.time())
+                )
+                # evict the oldest values past max_items, walking the created_at index from the newest
+                conn.execute(
+                    "DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                    (max(self.max_items, 0),)
+                )
+        finally:
+            conn.close()
+
+        return None
+
+
+    def clear(self) -> None:
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute("DELETE FROM results")
+        finally:
+            conn.close()
+
+        return None
+
+
+    def __len__(self) -> int:
+        conn = self.connect()
+        try:
+            return conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        finally:
+            conn.close()
+
+
+class ResultCache:
+    """ResultCache looks values up in memory first, then on disk, and keeps hit and miss counts.
+    Async code uses get_async() and set_async(), which run get() and set() in a thread when
+    there's a disk tier.
+    """
+
+    def __init__(self, max_items: int = CACHE_MAX_ITEMS, db_path: str = CACHE_DB_PATH):
+        self.memory = LRUCache(max_items)
+        self.disk = SQLiteCache(db_path) if db_path else None
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'sets': 0}
+        self.lock = threading.Lock()  # for the memory tier and stats, shared with the threads of get_async()
+
+
+    def count(self, stat: str) -> None:
+        with self.lock:
+            self.stats[stat] += 1
+        return None
+
+
+    def get(self, key: str):
+        "Return the cached value of key, or None"
+        with self.lock:
+            value = self.memory.get(key)
+        if value is not None:
+            self.count('memory_hits')
+            return value
+
+        if self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                with self.lock:
+                    self.memory.set(key, value)  # promote, so the next hit doesn't touch the disk
+                self.count('disk_hits')
+                return value
+
+        self.count('misses')
+        return None
+
+
+    def set(self, key: str, value) -> None:
+        with self.lock:
+            self.memory.set(key, value)
+        if self.disk is not None:
+            self.disk.set(key, value)
+        self.count('sets')
+
+        return None
+
+
+    async def get_async(self, key: str):
+        "Same as get(), from async code"
+        if self.disk is None:
+            return self.get(key)
+        return await run_in_thread(self.get, key)
+
+
+    async def set_async(self, key: str, value) -> None:
+        "Same as set(), from async code"
+        if self.disk is None:
+            return self.set(key, value)
+        return await run_in_thread(self.set, key, value)
+
+
+    def clear(self) -> None:
+        with self.lock:
+            self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+        return None
+
+
+    def get_stats(self) -> dict:
+        "Return hit and miss counts, hit rate and the size of each tier"
+        n_hits = self.stats['memory_hits'] + self.stats['disk_hits']
+        n_lookups = n_hits + self.stats['misses']
+        return {
+            **self.stats,
+            'hit_rate': n_hits / n_lookups if n_lookups > 0 else None,
+            'memory_items': len(self.memory),
+            'memory_max_items': self.memory.max_items,
+            'disk_items': len(self.disk) if self.disk is not None else None,
+            'engine_version': ENGINE_VERSION,
+        }
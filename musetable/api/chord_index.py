@@ -0,0 +1,109 @@
+"""
+Corpus-wide chord progression index.  Each harmonic phrase is stored as its sequence
+of chord transitions, where a transition is the root movement from the previous chord
+('prev_chord_root_dist' in the chords table) and the quality of the new chord.  Chord
+qualities are grouped using chord_kind_dict, so searches are key invariant and treat
+e.g. 'dominant' and 'dominant-ninth' the same, unless exact chord kinds are given.
+
+Example:
+    chord_index = ChordIndex()
+    chord_index.add_file(mxl_filepath)
+
+    # ii - V - I in any key
+    chord_index.search([(5, 'maj_3_min_7'), (5, 'maj_3_no_7')], start_kind='min_3_min_7')
+"""
+
+from typing import Mapping, Sequence
+
+from const import chord_kind_dict
+from ngram_index import NGramIndex
+
+KIND_TO_QUALITY = {kind: quality for quality, kinds in chord_kind_dict.items() for kind in kinds}
+
+
+class ChordIndex(NGramIndex):
+    "ChordIndex finds chord progressions in the harmonic phrases of a corpus"
+
+    def get_quality(self, kind: str) -> str:
+        "Return the chord_kind_dict quality for a music21 chord kind, or the quality itself"
+        if kind in chord_kind_dict:
+            return kind
+        return KIND_TO_QUALITY.get(kind, 'other')
+
+
+    def make_phrases(self, data_dict: Mapping[str, Mapping[str, list]]) -> dict:
+        "Group the chords of a track by harmonic phrase, ignoring chords outside of phrases"
+
+        track_id = data_dict['tracks']['track_id'][0]
+        chords = data_dict['chords']
+
+        phrases = {}
+        for i, hp_id in enumerate(chords['hp_id']):
+            if hp_id is None:
+                continue
+            phrase = phrases.setdefault(hp_id, {
+                'track_id': track_id,
+                'sec_id': chords['sec_id'][i],
+                'ids': [],
+                'kinds': [],
+                'tokens': [],
+            })
+
+            # the first chord of a phrase has no transition within the phrase
+            if len(phrase['ids']) > 0:
+                phrase['tokens'].append((chords['prev_chord_root_dist'][i], self.get_quality(chords['chord_kind'][i])))
+            phrase['ids'].append(chords['chord_id'][i])
+            phrase['kinds'].append(chords['chord_kind'][i])
+
+        return phrases
+
+
+    def search(self, progression: Sequence[tuple], start_kind: str = None) -> list:
+        """
+        Find every harmonic phrase containing a chord progression.
+
+        Parameters:
+        -----------
+        progression : list of (root_dist, kind) transitions.  root_dist is the root movement
+                      in half steps from the previous chord (-5 to 6, as in 'prev_chord_root_dist').
+                      kind is either a quality from chord_kind_dict (e.g. 'min_3_min_7'), or
+                      a music21 chord kind (e.g. 'minor-seventh') to match exactly
+        start_kind  : optional, quality or chord kind of the progression's first chord
+
+        Returns:
+        --------
+        hits    : list of (track_id, sec_id, hp_id, chord_id) tuples, where chord_id is the
+                  first chord of the match
+        """
+        pattern = [(root_dist, self.get_quality(kind)) for root_dist, kind in progression]
+        exact_kinds = [kind if kind not in chord_kind_dict else None for _, kind in progression]
+
+        hits = []
+        for hp_id, pos in self.find(pattern):
+            phrase = self.phrases[hp_id]
+            kinds = phrase['kinds'][pos + 1:pos + 1 + len(pattern)]
+            if any(exact is not None and exact != kind for exact, kind in zip(exact_kinds, kinds)):
+                continue
+            if start_kind is not None and start_kind not in (phrase['kinds'][pos], self.get_quality(phrase['kinds'][pos])):
+                continue
+            hits.append((phrase['track_id'], phrase['sec_id'], hp_id, phrase['ids'][pos]))
+
+        return hits
+
+
+    def search_like(self, hp_id: str) -> list:
+        "Find every harmonic phrase containing the same progression as an indexed harmonic phrase"
+        phrase = self.phrases[hp_id]
+
+        return [
+            hit for hit in self.search(phrase['tokens'], start_kind=self.get_quality(phrase['kinds'][0]))
+            if hit[2] != hp_id
+        ]
+
+
+    def search_like_section(self, sec_id: str) -> dict:
+        "Run search_like() for every harmonic phrase of an indexed section"
+        return {
+            hp_id: self.search_like(hp_id)
+            for hp_id, phrase in self.phrases.items() if phrase['sec_id'] == sec_id
+        }
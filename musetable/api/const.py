@@ -6,7 +6,49 @@ ROOT_DIR = os.path.abspath(os.path.join(my_path, os.pardir, os.pardir))  # get p
 SCOPE = 'local'
 # SCOPE = 'flask'  # changing scope will adjust how file upload works
 
+# largest request body accepted by the upload endpoints, in bytes
+MAX_UPLOAD_BYTES = int(os.environ.get('MUSETABLE_MAX_UPLOAD_BYTES', 10 * 1024 * 1024))
+MAX_BATCH_UPLOAD_BYTES = int(os.environ.get('MUSETABLE_MAX_BATCH_UPLOAD_BYTES', 200 * 1024 * 1024))
+MAX_BATCH_FILES = int(os.environ.get('MUSETABLE_MAX_BATCH_FILES', 500))
+# largest MusicXML score accepted once a .mxl archive is decompressed, in bytes
+MAX_MUSICXML_BYTES = int(os.environ.get('MUSETABLE_MAX_MUSICXML_BYTES', 50 * 1024 * 1024))
+
+# number of worker processes that run PreprocessXML for the API, and how long a request waits for one, in seconds
+MAX_WORKERS = int(os.environ.get('MUSETABLE_MAX_WORKERS', os.cpu_count() or 1))
+JOB_TIMEOUT = float(os.environ.get('MUSETABLE_JOB_TIMEOUT', 120))
+# seconds between polls of a worker's event queue by /preprocess/stream
+STREAM_POLL_SECONDS = 0.05
+
+# admission control: total estimated cost of files processed at once (a small lead sheet costs 1),
+# requests that can wait for capacity, and how long they wait before giving up, in seconds
+ADMISSION_CAPACITY = float(os.environ.get('MUSETABLE_ADMISSION_CAPACITY', 2 * MAX_WORKERS))
+ADMISSION_MAX_QUEUE = int(os.environ.get('MUSETABLE_ADMISSION_MAX_QUEUE', 64))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('MUSETABLE_ADMISSION_QUEUE_TIMEOUT', 60))
+
+# allow ?profile=true on the preprocess endpoints, which returns a cProfile report with the data
+PROFILING_ENABLED = os.environ.get('MUSETABLE_PROFILING_ENABLED', '').lower() in ('1', 'true', 'yes')
+
+# results kept in memory by each API process, and an optional SQLite file shared by all of them
+CACHE_MAX_ITEMS = int(os.environ.get('MUSETABLE_CACHE_MAX_ITEMS', 128))
+CACHE_DB_PATH = os.environ.get('MUSETABLE_CACHE_DB_PATH')
+CACHE_DB_MAX_ITEMS = int(os.environ.get('MUSETABLE_CACHE_DB_MAX_ITEMS', 10000))  # oldest results are evicted past this
+
+# jobs of the /jobs endpoints are kept in memory, or in a SQLite file shared by all API processes if set
+JOB_DB_PATH = os.environ.get('MUSETABLE_JOB_DB_PATH')
+JOB_TTL = float(os.environ.get('MUSETABLE_JOB_TTL', 3600))  # seconds finished jobs are kept
+# seconds a running job's claim lasts without a heartbeat from its consumer, before another process requeues it
+JOB_LEASE = float(os.environ.get('MUSETABLE_JOB_LEASE', 60))
+
 BASIC_TABLES = ['tracks', 'sections', 'melodic_phrases', 'harmonic_phrases', 'notes', 'chords']
+# tables that are complete once a stage of PreprocessXML.input_all() has finished
+STAGE_TABLES = {
+    'basic_tables': BASIC_TABLES,
+    'comprehensive_sections': ['tracks_form', 'tracks_melody', 'tracks_harmony', 'sections_form', 'sections_melody', 'sections_harmony'],
+    'comprehensive_mps': ['melodic_phrases_details'],
+    'comprehensive_hps': ['harmonic_phrases_details'],
+    'comprehensive_notes': ['notes_details'],
+    'comprehensive_chords': ['chords_details'],
+}
 NULLABLE_COLUMNS = [
     ('notes', 'mp_id'),
     ('chords', 'sec_id'),
@@ -0,0 +1,418 @@
+"""
+Asynchronous preprocessing jobs.  POST /jobs stores a job and returns its id straight away,
+and consumer tasks in each API process take queued jobs from the store and run them.
+
+The store is pluggable: MemoryJobStore keeps jobs in the API process, and SQLiteJobStore
+keeps them in a SQLite file, so every uvicorn worker on the machine can take queued jobs
+and answer status requests, and queued jobs survive a restart.  Consumers renew a lease on
+the jobs they run, and a running job whose lease expired, because its process crashed, is
+queued again.
+"""
+
+import asyncio
+import functools
+import pickle
+import sqlite3
+import time
+import uuid
+import zlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+
+from const import JOB_LEASE, JOB_TTL
+
+JOB_FIELDS = [
+    'job_id', 'status', 'stage', 'filename', 'options', 'cache_key', 'status_code', 'error',
+    'created_at', 'started_at', 'finished_at', 'heartbeat_at',
+]
+FINISHED_STATUSES = ('done', 'failed')
+
+
+def make_job(filename: str, options: dict) -> dict:
+    "Make the record of a new, queued job"
+    return {
+        'job_id': uuid.uuid4().hex,
+        'status': 'queued',
+        'stage': 'queued',
+        'filename': filename,
+        'options': options,
+        'cache_key': None,
+        'status_code': None,
+        'error': None,
+        'created_at': time.time(),
+        'started_at': None,
+        'finished_at': None,
+        'heartbeat_at': None,
+    }
+
+
+def get_job_timings(job: dict) -> dict:
+    "Seconds a job spent queued and running so far"
+    now = time.time()
+    started_at = job['started_at'] or now
+    return {
+        'queued_seconds': started_at - job['created_at'],
+        'run_seconds': (job['finished_at'] or now) - job['started_at'] if job['started_at'] else None,
+    }
+
+
+class JobStore(ABC):
+    "JobStore is the interface of job backends"
+    blocking = True  # whether calls do I/O, and are run in a thread by JobManager
+
+    @abstractmethod
+    def enqueue(self, job: dict, mxl_bytes: bytes) -> None:
+        "Store a new job, with the file it processes"
+
+
+    @abstractmethod
+    def claim(self) -> Optional[tuple]:
+        "Mark the oldest queued job as running and return (job, mxl_bytes), or None if no job is queued"
+
+
+    @abstractmethod
+    def heartbeat(self, job_id: str) -> None:
+        "Renew the lease of a running job"
+
+
+    @abstractmethod
+    def get(self, job_id: str) -> Optional[dict]:
+        "Return the record of a job, or None if there's no such job"
+
+
+    @abstractmethod
+    def update(self, job_id: str, **fields) -> None:
+        "Set fields of the record of a job"
+
+
+    @abstractmethod
+    def set_result(self, job_id: str, result) -> None:
+        "Store the result of a finished job"
+
+
+    @abstractmethod
+    def get_result(self, job_id: str):
+        "Return the result of a finished job, or None"
+
+
+    @abstractmethod
+    def purge(self, before: float) -> None:
+        "Delete jobs that finished before a timestamp"
+
+
+    @abstractmethod
+    def count(self, status: str) -> int:
+        "Count the jobs with a status"
+
+
+class MemoryJobStore(JobStore):
+    "MemoryJobStore keeps jobs in dicts, in the API process"
+    blocking = False
+
+    def __init__(self):
+        self.jobs = OrderedDict()  # job_id: job, in the order they were queued
+        self.inputs = {}  # job_id: mxl_bytes, until the job finishes
+        self.results = {}
+
+
+    def enqueue(self, job: dict, mxl_bytes: bytes) -> None:
+        self.jobs[job['job_id']] = job
+        self.inputs[job['job_id']] = mxl_bytes
+        return None
+
+
+    def claim(self) -> Optional[tuple]:
+        for job_id, job in self.jobs.items():
+            if job['status'] == 'queued':
+                job.update({'status': 'running', 'stage': 'starting', 'started_at': time.time(), 'heartbeat_at': time.time()})
+                return (dict(job), self.inputs[job_id])
+        return None
+
+
+    def heartbeat(self, job_id: str) -> None:
+        # jobs in memory die with the process that runs them, so leases never expire
+        self.jobs[job_id]['heartbeat_at'] = time.time()
+        return None
+
+
+    def get(self, job_id: str) -> Optional[dict]:
+        job = self.jobs.get(job_id)
+        return None if job is None else dict(job)
+
+
+    def update(self, job_id: str, **fields) -> None:
+        self.jobs[job_id].update(fields)
+        if fields.get('status') in FINISHED_STATUSES:
+            self.inputs.pop(job_id, None)  # the file is only needed to run the job again
+        return None
+
+
+    def set_result(self, job_id: str, result) -> None:
+        self.results[job_id] = result
+        return None
+
+
+    def get_result(self, job_id: str):
+        return self.results.get(job_id)
+
+
+    def purge(self, before: float) -> None:
+        for job_id, job in list(self.jobs.items()):
+            if job['status'] in FINISHED_STATUSES and job['finished_at'] < before:
+                del self.jobs[job_id]
+                self.results.pop(job_id, None)
+        return None
+
+
+    def count(self, status: str) -> int:
+        return sum(job['status'] == status for job in self.jobs.values())
+
+
+class SQLiteJobStore(JobStore):
+    """SQLiteJobStore keeps jobs in a SQLite file shared by several processes.  Jobs are claimed
+    in an immediate transaction, so each queued job is taken by exactly one consumer.  A
+    job's file is kept until it finishes, so a running job whose lease (seconds since its
+    last heartbeat) expired can be queued again.
+    """
+
+    def __init__(self, db_path: str, lease: float = JOB_LEASE):
+        self.db_path = db_path
+        self.lease = lease
+        conn = self.connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "job_id TEXT PRIMARY KEY, status TEXT NOT NULL, stage TEXT, filename TEXT, options BLOB, "
+                "cache_key TEXT, status_code INTEGER, error TEXT, "
+                "created_at REAL NOT NULL, started_at REAL, finished_at REAL, heartbeat_at REAL, "
+                "input BLOB, result BLOB)"
+            )
+            # files made before leases were added
+            if 'heartbeat_at' not in [row[1] for row in conn.execute("PRAGMA table_info(jobs)")]:
+                conn.execute("ALTER TABLE jobs ADD COLUMN heartbeat_at REAL")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status_created_at ON jobs (status, created_at)")
+        finally:
+            conn.close()
+
+
+    def connect(self) -> sqlite3.Connection:
+        # autocommit mode, transactions are opened explicitly where needed
+        return sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+
+
+    def row_to_job(self, row: tuple) -> dict:
+        job = dict(zip(JOB_FIELDS, row))
+        job['options'] = pickle.loads(job['options'])
+        return job
+
+
+    def enqueue(self, job: dict, mxl_bytes: bytes) -> None:
+        row = {**job, 'options': pickle.dumps(job['options'])}
+        conn = self.connect()
+        try:
+            conn.execute(
+                f"INSERT INTO jobs ({', '.join(JOB_FIELDS)}, input) VALUES ({', '.join('?' * (len(JOB_FIELDS) + 1))})",
+                [row[field] for field in JOB_FIELDS] + [zlib.compress(mxl_bytes)]
+            )
+        finally:
+            conn.close()
+
+        return None
+
+
+    def claim(self) -> Optional[tuple]:
+        conn = self.connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")  # take the write lock before reading, so no other consumer claims the same job
+            conn.execute(
+                "UPDATE jobs SET status = 'queued', stage = 'queued', started_at = NULL, heartbeat_at = NULL "
+                "WHERE status = 'running' AND heartbeat_at < ?",
+                (time.time() - self.lease,)
+            )
+            row = conn.execute(
+                f"SELECT {', '.join(JOB_FIELDS)}, input FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1"
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+
+            job = self.row_to_job(row[:-1])
+            job.update({'status': 'running', 'stage': 'starting', 'started_at': time.time(), 'heartbeat_at': time.time()})
+            conn.execute(
+                "UPDATE jobs SET status = ?, stage = ?, started_at = ?, heartbeat_at = ? WHERE job_id = ?",
+                (job['status'], job['stage'], job['started_at'], job['heartbeat_at'], job['job_id'])
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+        return (job, zlib.decompress(row[-1]))
+
+
+    def get(self, job_id: str) -> Optional[dict]:
+        conn = self.connect()
+        try:
+            row = conn.execute(f"SELECT {', '.join(JOB_FIELDS)} FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        finally:
+            conn.close()
+
+        return None if row is None else self.row_to_job(row)
+
+
+    def heartbeat(self, job_id: str) -> None:
+        self.update(job_id, heartbeat_at=time.time())
+        return None
+
+
+    def update(self, job_id: str, **fields) -> None:
+        if fields.get('status') in FINISHED_STATUSES:
+            fields['input'] = None  # the file is only needed to run the job again
+        conn = self.connect()
+        try:
+            conn.execute(
+                f"UPDATE jobs SET {', '.join(f'{field} = ?' for field in fields)} WHERE job_id = ?",
+                list(fields.values()) + [job_id]
+            )
+        finally:
+            conn.close()
+
+        return None
+
+
+    def set_result(self, job_id: str, result) -> None:
+        self.update(job_id, result=zlib.compress(pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)))
+        return None
+
+
+    def get_result(self, job_id: str):
+        conn = self.connect()
+        try:
+            row = conn.execute("SELECT result FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        finally:
+            conn.close()
+
+        return None if row is None or row[0] is None else pickle.loads(zlib.decompress(row[0]))
+
+
+    def purge(self, before: float) -> None:
+        conn = self.connect()
+        try:
+            conn.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?", (before,))
+        finally:
+            conn.close()
+
+        return None
+
+
+    def count(self, status: str) -> int:
+        conn = self.connect()
+        try:
+            return conn.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (status,)).fetchone()[0]
+        finally:
+            conn.close()
+
+
+class JobManager:
+    """
+    JobManager queues jobs in a JobStore, and runs n_consumers tasks that take queued jobs
+    and process them with runner, a coroutine function of (job, mxl_bytes) that returns
+    (cache_key, result) or raises an HTTPException-like error with status_code and detail.
+    """
+
+    def __init__(self, store: JobStore, runner: Callable[[dict, bytes], Awaitable[tuple]], n_consumers: int = 1, poll_interval: float = 0.5, ttl: float = JOB_TTL, lease: float = JOB_LEASE):
+        self.store = store
+        self.runner = runner
+        self.n_consumers = n_consumers
+        self.poll_interval = poll_interval  # how often consumers look for jobs queued by other processes
+        self.ttl = ttl  # seconds finished jobs are kept
+        self.heartbeat_interval = lease / 3  # renew leases well before they expire
+        self.consumers = []
+        self.wakeup = None
+
+
+    def start(self) -> None:
+        "Start the consumer tasks, from a running event loop"
+        self.wakeup = asyncio.Event()
+        self.consumers = [asyncio.ensure_future(self.consume()) for _ in range(self.n_consumers)]
+        return None
+
+
+    async def stop(self) -> None:
+        "Cancel the consumer tasks.  Jobs that were running are queued again"
+        for consumer in self.consumers:
+            consumer.cancel()
+        await asyncio.gather(*self.consumers, return_exceptions=True)
+        self.consumers = []
+
+        return None
+
+
+    async def call_store(self, method: str, *args, **kwargs):
+        "Call a method of the store, in a thread if it blocks on I/O"
+        func = functools.partial(getattr(self.store, method), *args, **kwargs)
+        if not self.store.blocking:
+            return func()
+        return await asyncio.get_running_loop().run_in_executor(None, func)
+
+
+    async def submit(self, mxl_bytes: bytes, filename: str, options: dict) -> dict:
+        "Queue a job and return its record"
+        await self.call_store('purge', time.time() - self.ttl)
+        job = make_job(filename, options)
+        await self.call_store('enqueue', job, mxl_bytes)
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+        return job
+
+
+    async def consume(self) -> None:
+        "Run queued jobs one at a time, forever"
+        while True:
+            claimed = await self.call_store('claim')
+            if claimed is None:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self.run(*claimed)
+
+
+    async def keep_alive(self, job_id: str) -> None:
+        "Renew the lease of a running job until cancelled"
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            await self.call_store('heartbeat', job_id)
+
+
+    async def run(self, job: dict, mxl_bytes: bytes) -> None:
+        "Run one claimed job, and record its result or its error"
+        job_id = job['job_id']
+        heartbeat = asyncio.ensure_future(self.keep_alive(job_id))
+        try:
+            await self.call_store('update', job_id, stage='preprocessing')
+            cache_key, result = await self.runner(job, mxl_bytes)
+        except asyncio.CancelledError:
+            # the server is shutting down: queue the job again, for the next process to run with the SQLite store
+            await self.call_store('update', job_id, status='queued', stage='queued', started_at=None, heartbeat_at=None)
+            raise
+        except Exception as e:
+            status_code = getattr(e, 'status_code', 500)
+            error = getattr(e, 'detail', f"{type(e).__name__}: {e}")
+            await self.call_store('update', job_id, status='failed', stage='failed', status_code=status_code, error=error, finished_at=time.time())
+            return None
+        finally:
+            heartbeat.cancel()
+
+        await self.call_store('set_result', job_id, result)
+        await self.call_store('update', job_id, status='done', stage='done', cache_key=cache_key, status_code=200, finished_at=time.time())
+
+        return None
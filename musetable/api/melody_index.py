@@ -0,0 +1,81 @@
+"""
+Corpus-wide melodic interval index.  Each melodic phrase is stored as its sequence of
+intervals (the 'prev_note_distance' column of the notes table), so searches are
+transposition invariant by default.  Durations and pitch classes are kept with each
+phrase, allowing searches to optionally match rhythm and starting pitch as well.
+
+Example:
+    melody_index = MelodyIndex()
+    melody_index.add_file(mxl_filepath)
+    melody_index.search([2, 2, -4])  # -> [(track_id, sec_id, mp_id, note_id), ...]
+    melody_index.save(index_filepath)
+"""
+
+import numpy as np
+from typing import Mapping, Sequence
+
+from ngram_index import NGramIndex
+
+
+class MelodyIndex(NGramIndex):
+    "MelodyIndex finds interval patterns in the melodic phrases of a corpus"
+
+    def make_phrases(self, data_dict: Mapping[str, Mapping[str, list]]) -> dict:
+        "Group the notes of a track by melodic phrase, ignoring rests and notes outside of phrases"
+
+        track_id = data_dict['tracks']['track_id'][0]
+        notes = data_dict['notes']
+
+        phrases = {}
+        for i, mp_id in enumerate(notes['mp_id']):
+            if mp_id is None or notes['midi_num'][i] == -1:
+                continue
+            phrase = phrases.setdefault(mp_id, {
+                'track_id': track_id,
+                'sec_id': notes['sec_id'][i],
+                'ids': [],
+                'pitch_classes': [],
+                'durations': [],
+                'tokens': [],
+            })
+
+            # the first note of a phrase has no interval within the phrase
+            if len(phrase['ids']) > 0:
+                phrase['tokens'].append(notes['prev_note_distance'][i])
+            phrase['ids'].append(notes['note_id'][i])
+            phrase['pitch_classes'].append(notes['pitch_class'][i])
+            phrase['durations'].append(notes['duration'][i])
+
+        return phrases
+
+
+    def search(self, intervals: Sequence[int], durations: Sequence[float] = None, pitch_class: int = None) -> list:
+        """
+        Find every melodic phrase containing a sequence of intervals.
+
+        Parameters:
+        -----------
+        intervals   : intervals in half steps between consecutive notes, e.g. [2, 2, -4]
+        durations   : optional, durations in quarter lengths for each note of the pattern
+                      (len(intervals) + 1 values).  If None, rhythm is ignored
+        pitch_class : optional, pitch class of the pattern's first note.  If None, the
+                      search is transposition invariant
+
+        Returns:
+        --------
+        hits    : list of (track_id, sec_id, mp_id, note_id) tuples, where note_id is the
+                  first note of the match
+        """
+        if durations is not None:
+            assert len(durations) == len(intervals) + 1, "durations needs one value per note (len(intervals) + 1)"
+
+        hits = []
+        for mp_id, pos in self.find(intervals):
+            phrase = self.phrases[mp_id]
+            if pitch_class is not None and phrase['pitch_classes'][pos] != pitch_class:
+                continue
+            if durations is not None and not np.allclose(phrase['durations'][pos:pos + len(durations)], durations):
+                continue
+            hits.append((phrase['track_id'], phrase['sec_id'], mp_id, phrase['ids'][pos]))
+
+        return hits
@@ -0,0 +1,164 @@
+"""
+A minimal metrics registry, rendered in the Prometheus text exposition format by /metrics.
+
+Each API process keeps its own metrics, so with several uvicorn workers, Prometheus sees
+the process that answered the scrape.  Counters are totals since the process started:
+use rate() for per-second values, e.g. rate(musetable_notes_processed_total[5m]).
+"""
+
+import bisect
+from typing import Callable, Mapping, Sequence
+
+PROMETHEUS_MEDIA_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# seconds, from a tiny lead sheet's stage up to a long comprehensive run
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def format_labels(labels: Mapping[str, str]) -> str:
+    if not labels:
+        return ''
+    escaped = {name: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for name, value in labels.items()}
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped.items()) + '}'
+
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric:
+    "Metric holds one value per combination of label values"
+    metric_type = None
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.values = {}  # label values tuple: value
+
+
+    def get_key(self, labels: Mapping[str, str]) -> tuple:
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name} has labels {self.label_names}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+
+    def get_samples(self) -> list:
+        "Return (name, labels, value) of every sample of the metric"
+        return [(self.name, dict(zip(self.label_names, key)), value) for key, value in self.values.items()]
+
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        lines += [f"{name}{format_labels(labels)} {format_value(value)}" for name, labels, value in self.get_samples()]
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    "Counter values are increased, or read from func when the metric is rendered, for totals kept elsewhere"
+    metric_type = 'counter'
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = (), func: Callable[[], float] = None):
+        super().__init__(name, documentation, label_names)
+        self.func = func
+
+
+    def get_samples(self) -> list:
+        if self.func is not None:
+            return [(self.name, {}, self.func())]
+        return super().get_samples()
+
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        if amount < 0:
+            raise ValueError("counters can only increase")
+        key = self.get_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+        return None
+
+
+class Gauge(Metric):
+    "Gauge values are set directly, or read from func when the metric is rendered"
+    metric_type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = (), func: Callable[[], float] = None):
+        super().__init__(name, documentation, label_names)
+        self.func = func
+
+
+    def set(self, value: float, **labels) -> None:
+        self.values[self.get_key(labels)] = value
+        return None
+
+
+    def get_samples(self) -> list:
+        if self.func is not None:
+            value = self.func()
+            return [] if value is None else [(self.name, {}, value)]
+        return super().get_samples()
+
+
+class Histogram(Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+
+    def observe(self, value: float, **labels) -> None:
+        key = self.get_key(labels)
+        if key not in self.values:
+            self.values[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+        series = self.values[key]
+        series['counts'][bisect.bisect_left(self.buckets, value)] += 1  # le is inclusive
+        series['sum'] += value
+        series['count'] += 1
+
+        return None
+
+
+    def get_samples(self) -> list:
+        samples = []
+        for key, series in self.values.items():
+            labels = dict(zip(self.label_names, key))
+            cumulative = 0
+            for bucket, count in zip(self.buckets, series['counts']):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", {**labels, 'le': format_value(bucket)}, cumulative))
+            samples.append((f"{self.name}_sum", labels, series['sum']))
+            samples.append((f"{self.name}_count", labels, series['count']))
+        return samples
+
+
+class Registry:
+    "Registry holds the metrics of the process, and renders them for /metrics"
+
+    def __init__(self):
+        self.metrics = {}
+
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f"metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+
+    def counter(self, name: str, documentation: str, label_names: Sequence[str] = (), func: Callable[[], float] = None) -> Counter:
+        return self.register(Counter(name, documentation, label_names, func))
+
+
+    def gauge(self, name: str, documentation: str, label_names: Sequence[str] = (), func: Callable[[], float] = None) -> Gauge:
+        return self.register(Gauge(name, documentation, label_names, func))
+
+
+    def histogram(self, name: str, documentation: str, label_names: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, label_names, buckets))
+
+
+    def render(self) -> str:
+        return '\n'.join(metric.render() for metric in self.metrics.values()) + '\n'
+
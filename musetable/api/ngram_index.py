@@ -0,0 +1,121 @@
+"""
+Inverted n-gram index over the phrases of a corpus of tracks.  Each phrase is
+stored as a sequence of hashable tokens, and every n-gram of length 1 to max_n
+points back to the phrases and positions it occurs at.  Subclasses decide how
+the tokens are made from PreprocessXML's data_dict.
+"""
+
+import pickle
+from abc import ABC, abstractmethod
+from typing import Hashable, Mapping, Sequence
+
+
+class NGramIndex(ABC):
+    "NGramIndex stores phrase token sequences and finds token patterns in them"
+
+    def __init__(self, max_n: int = 4):
+        self.max_n = max_n
+        self.phrases = {}  # phrase_id -> dict with 'track_id', 'sec_id', 'ids' and 'tokens'
+        self.track_phrases = {}  # track_id -> list of phrase ids
+        self.index = {}  # n-gram tuple -> {phrase_id: [positions]}
+
+
+    @abstractmethod
+    def make_phrases(self, data_dict: Mapping[str, Mapping[str, list]]) -> dict:
+        "Return {phrase_id: phrase dict} for one track.  Implemented by subclasses"
+
+
+    def iter_ngrams(self, tokens: Sequence[Hashable]):
+        "yield (position, n-gram) for every n-gram of length 1 to max_n"
+        for pos in range(len(tokens)):
+            for n in range(1, min(self.max_n, len(tokens) - pos) + 1):
+                yield (pos, tuple(tokens[pos:pos + n]))
+
+
+    def add_track(self, data_dict: Mapping[str, Mapping[str, list]]) -> None:
+        """Add (or replace) all phrases of one track.  data_dict is the data_dict of a
+        PreprocessXML instance after input_all() has been run.
+        """
+        track_id = data_dict['tracks']['track_id'][0]
+        self.remove_track(track_id)
+
+        phrases = self.make_phrases(data_dict)
+        for phrase_id, phrase in phrases.items():
+            self.phrases[phrase_id] = phrase
+            for pos, gram in self.iter_ngrams(phrase['tokens']):
+                self.index.setdefault(gram, {}).setdefault(phrase_id, []).append(pos)
+        self.track_phrases[track_id] = list(phrases.keys())
+
+        return None
+
+
+    def add_file(self, mxl_filepath: str) -> None:
+        "Preprocess a MusicXML file and add it to the index"
+        from preprocess import PreprocessXML  # only import music21 when files are processed
+
+        preproc = PreprocessXML()
+        preproc.load_data(mxl_filepath, comprehensive=False)
+        preproc.input_all()
+        self.add_track(preproc.data_dict)
+
+        return None
+
+
+    def remove_track(self, track_id: str) -> None:
+        "Remove every phrase of a track from the index"
+        for phrase_id in self.track_phrases.pop(track_id, []):
+            phrase = self.phrases.pop(phrase_id)
+            for _, gram in self.iter_ngrams(phrase['tokens']):
+                postings = self.index.get(gram)
+                if postings is None:
+                    continue
+                postings.pop(phrase_id, None)
+                if len(postings) == 0:
+                    del self.index[gram]
+
+        return None
+
+
+    def find(self, pattern: Sequence[Hashable]) -> list:
+        """Return a list of (phrase_id, position) for every occurence of pattern.  Patterns
+        longer than max_n are looked up with their first max_n tokens, then checked against
+        the stored phrase tokens.
+        """
+        pattern = tuple(pattern)
+        if len(pattern) == 0:
+            return []
+
+        postings = self.index.get(pattern[:self.max_n], {})
+        matches = []
+        for phrase_id, positions in postings.items():
+            tokens = self.phrases[phrase_id]['tokens']
+            for pos in positions:
+                if len(pattern) <= self.max_n or tuple(tokens[pos:pos + len(pattern)]) == pattern:
+                    matches.append((phrase_id, pos))
+
+        return matches
+
+
+    def save(self, filepath: str) -> None:
+        "Save index to disk"
+        with open(filepath, 'wb') as file:
+            pickle.dump(
+                {'max_n': self.max_n, 'phrases': self.phrases, 'track_phrases': self.track_phrases, 'index': self.index},
+                file, protocol=pickle.HIGHEST_PROTOCOL
+            )
+
+        return None
+
+
+    @classmethod
+    def load(cls, filepath: str):
+        "Load an index saved with save()"
+        with open(filepath, 'rb') as file:
+            saved = pickle.load(file)
+
+        ngram_index = cls(max_n=saved['max_n'])
+        ngram_index.phrases = saved['phrases']
+        ngram_index.track_phrases = saved['track_phrases']
+        ngram_index.index = saved['index']
+
+        return ngram_index
@@ -0,0 +1,242 @@
+"""
+Melodic phrase embeddings for "find phrases like this one" searches.  Each melodic
+phrase is embedded as a fixed length vector made of:
+    - a duration weighted pitch class histogram (12 bins)
+    - an interval histogram, with intervals clipped to an octave (25 bins)
+    - a rhythm onset histogram of where notes start within the beat (12 bins)
+Vectors are L2 normalized and stacked into a NumPy matrix, so cosine similarity for a
+batch of queries is a single matrix product, which takes milliseconds for tens of
+thousands of phrases.  Once the corpus is larger than lsh_threshold phrases, candidates
+can be narrowed down with random projection LSH first.
+
+Example:
+    embedding = PhraseEmbedding()
+    embedding.add_file(mxl_filepath)
+    embedding.similar_to(['stevpstpc-mp1-3.5'], k=5)  # -> [[(mp_id, similarity), ...]]
+    embedding.save(embedding_filepath)
+"""
+
+import numpy as np
+from typing import Mapping, Sequence, Union
+
+N_PITCH_CLASSES = 12
+MAX_INTERVAL = 12  # intervals are clipped to +/- an octave
+N_ONSET_BINS = 12  # divides the beat into 16th notes and triplets
+EMBEDDING_DIM = N_PITCH_CLASSES + (2 * MAX_INTERVAL + 1) + N_ONSET_BINS
+
+
+class PhraseEmbedding:
+    "PhraseEmbedding stores a matrix of melodic phrase vectors and finds nearest neighbours"
+
+    def __init__(self, lsh_threshold: int = 200000, lsh_bits: int = 12, lsh_tables: int = 8, seed: int = 0):
+        self.lsh_threshold = lsh_threshold
+        self.lsh_bits = lsh_bits
+        self.lsh_tables = lsh_tables
+        self.seed = seed
+
+        self.mp_ids = []
+        self.track_ids = []
+        self.sec_ids = []
+        self.matrix = np.zeros((0, EMBEDDING_DIM), dtype=np.float32)
+        self.lsh_buckets = None  # built lazily, and reset whenever the matrix changes
+
+
+    def embed_notes(self, pitch_classes: Sequence[int], durations: Sequence[float], intervals: Sequence[int], beats: Sequence[float]) -> np.ndarray:
+        "Make one L2 normalized phrase vector from the pitched notes of a phrase"
+
+        durations = np.asarray(durations, dtype=np.float64)
+
+        pc_hist = np.bincount(pitch_classes, weights=durations, minlength=N_PITCH_CLASSES)
+        interval_hist = np.bincount(
+            np.clip(intervals, -MAX_INTERVAL, MAX_INTERVAL).astype(int) + MAX_INTERVAL, minlength=2 * MAX_INTERVAL + 1
+        )
+        onset_bins = np.round((np.asarray(beats) % 1) * N_ONSET_BINS).astype(int) % N_ONSET_BINS
+        onset_hist = np.bincount(onset_bins, minlength=N_ONSET_BINS)
+
+        # normalize each histogram so every block carries the same weight
+        blocks = [hist / hist.sum() if hist.sum() > 0 else hist for hist in (pc_hist, interval_hist, onset_hist)]
+        vector = np.concatenate(blocks)
+
+        return vector / np.linalg.norm(vector)
+
+
+    def embed_phrases(self, data_dict: Mapping[str, Mapping[str, list]]) -> tuple:
+        "Return (mp_ids, sec_ids, matrix) for all melodic phrases of one track"
+
+        notes = data_dict['notes']
+        phrase_rows = {}
+        for i, mp_id in enumerate(notes['mp_id']):
+            if mp_id is None or notes['midi_num'][i] == -1:
+                continue
+            phrase_rows.setdefault(mp_id, []).append(i)
+
+        mp_ids, sec_ids, vectors = [], [], []
+        for mp_id, rows in phrase_rows.items():
+            vectors.append(self.embed_notes(
+                pitch_classes=[notes['pitch_class'][i] for i in rows],
+                durations=[notes['duration'][i] for i in rows],
+                intervals=[notes['prev_note_distance'][i] for i in rows[1:]],  # first note has no interval within phrase
+                beats=[notes['beat'][i] for i in rows],
+            ))
+            mp_ids.append(mp_id)
+            sec_ids.append(notes['sec_id'][rows[0]])
+
+        matrix = np.array(vectors, dtype=np.float32).reshape(-1, EMBEDDING_DIM)
+
+        return (mp_ids, sec_ids, matrix)
+
+
+    def add_track(self, data_dict: Mapping[str, Mapping[str, list]]) -> None:
+        """Add (or replace) all melodic phrases of one track.  data_dict is the data_dict of a
+        PreprocessXML instance after input_all() has been run.
+        """
+        track_id = data_dict['tracks']['track_id'][0]
+        self.remove_track(track_id)
+
+        mp_ids, sec_ids, matrix = self.embed_phrases(data_dict)
+        self.mp_ids.extend(mp_ids)
+        self.track_ids.extend([track_id] * len(mp_ids))
+        self.sec_ids.extend(sec_ids)
+        self.matrix = np.vstack([self.matrix, matrix])
+        self.lsh_buckets = None
+
+        return None
+
+
+    def add_file(self, mxl_filepath: str) -> None:
+        "Preprocess a MusicXML file and add it to the embedding matrix"
+        from preprocess import PreprocessXML  # only import music21 when files are processed
+
+        preproc = PreprocessXML()
+        preproc.load_data(mxl_filepath, comprehensive=False)
+        preproc.input_all()
+        self.add_track(preproc.data_dict)
+
+        return None
+
+
+    def remove_track(self, track_id: str) -> None:
+        "Remove all melodic phrases of a track"
+        keep = np.array([t_id != track_id for t_id in self.track_ids], dtype=bool)
+        if keep.all():
+            return None
+
+        self.mp_ids = [mp_id for mp_id, k in zip(self.mp_ids, keep) if k]
+        self.track_ids = [t_id for t_id, k in zip(self.track_ids, keep) if k]
+        self.sec_ids = [sec_id for sec_id, k in zip(self.sec_ids, keep) if k]
+        self.matrix = self.matrix[keep]
+        self.lsh_buckets = None
+
+        return None
+
+
+    def make_lsh_planes(self) -> np.ndarray:
+        "Random hyperplanes with shape (lsh_tables, lsh_bits, EMBEDDING_DIM)"
+        rng = np.random.default_rng(self.seed)
+        return rng.standard_normal((self.lsh_tables, self.lsh_bits, EMBEDDING_DIM)).astype(np.float32)
+
+
+    def get_lsh_keys(self, vectors: np.ndarray) -> np.ndarray:
+        "Return an array of bucket keys with shape (lsh_tables, n_vectors)"
+        bits = np.einsum('tbd,nd->tnb', self.make_lsh_planes(), vectors) > 0
+        return bits.astype(np.int64) @ (1 << np.arange(self.lsh_bits, dtype=np.int64))
+
+
+    def build_lsh(self) -> None:
+        "Hash every row of the matrix into lsh_tables tables of buckets"
+        self.lsh_buckets = []
+        for table_keys in self.get_lsh_keys(self.matrix):
+            order = np.argsort(table_keys, kind='stable')
+            keys, starts = np.unique(table_keys[order], return_index=True)
+            self.lsh_buckets.append({key: rows for key, rows in zip(keys, np.split(order, starts[1:]))})
+
+        return None
+
+
+    def knn(self, queries: np.ndarray, k: int = 10, use_lsh: bool = None) -> list:
+        """
+        Find the k nearest phrases (by cosine similarity) for a batch of query vectors.
+
+        Parameters:
+        -----------
+        queries : array of shape (n_queries, EMBEDDING_DIM), or a single vector
+        k       : number of neighbours to return for each query
+        use_lsh : narrow down candidates with LSH before computing exact similarities.
+                  If None, LSH is used once the corpus is larger than lsh_threshold
+
+        Returns:
+        --------
+        neighbours  : one list per query of (mp_id, similarity) tuples, most similar first
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        if use_lsh is None:
+            use_lsh = len(self.mp_ids) > self.lsh_threshold
+
+        if not use_lsh:
+            return [self.top_k(row, np.arange(len(self.mp_ids)), k) for row in queries @ self.matrix.T]
+
+        if self.lsh_buckets is None:
+            self.build_lsh()
+        empty = np.array([], dtype=np.int64)
+        neighbours = []
+        for i, query_keys in enumerate(self.get_lsh_keys(queries).T):
+            candidates = np.unique(np.concatenate(
+                [buckets.get(key, empty) for buckets, key in zip(self.lsh_buckets, query_keys)]
+            ))
+            neighbours.append(self.top_k(self.matrix[candidates] @ queries[i], candidates, k))
+
+        return neighbours
+
+
+    def top_k(self, similarities: np.ndarray, rows: np.ndarray, k: int) -> list:
+        "Return the k best (mp_id, similarity) tuples, sorted by similarity"
+        if len(rows) > k:
+            best = np.argpartition(-similarities, k)[:k]
+        else:
+            best = np.arange(len(rows))
+        best = best[np.argsort(-similarities[best], kind='stable')]
+
+        return [(self.mp_ids[rows[i]], float(similarities[i])) for i in best]
+
+
+    def similar_to(self, mp_ids: Union[str, Sequence[str]], k: int = 10, use_lsh: bool = None) -> list:
+        "Find the k phrases most similar to already embedded phrases, excluding the phrases themselves"
+        if isinstance(mp_ids, str):
+            mp_ids = [mp_ids]
+        row_lookup = {mp_id: i for i, mp_id in enumerate(self.mp_ids)}
+        queries = self.matrix[[row_lookup[mp_id] for mp_id in mp_ids]]
+
+        neighbours = self.knn(queries, k=k + 1, use_lsh=use_lsh)
+
+        return [
+            [(n_id, sim) for n_id, sim in query_neighbours if n_id != mp_id][:k]
+            for mp_id, query_neighbours in zip(mp_ids, neighbours)
+        ]
+
+
+    def save(self, filepath: str) -> None:
+        "Save embedding matrix and phrase ids to a .npz file"
+        np.savez(
+            filepath,
+            matrix=self.matrix,
+            mp_ids=np.array(self.mp_ids, dtype=str),
+            track_ids=np.array(self.track_ids, dtype=str),
+            sec_ids=np.array(self.sec_ids, dtype=str),
+            lsh_params=np.array([self.lsh_threshold, self.lsh_bits, self.lsh_tables, self.seed]),
+        )
+
+        return None
+
+
+    @classmethod
+    def load(cls, filepath: str):
+        "Load an embedding saved with save()"
+        with np.load(filepath) as saved:
+            lsh_threshold, lsh_bits, lsh_tables, seed = saved['lsh_params'].tolist()
+            embedding = cls(lsh_threshold=lsh_threshold, lsh_bits=lsh_bits, lsh_tables=lsh_tables, seed=seed)
+            embedding.matrix = saved['matrix']
+            embedding.mp_ids = saved['mp_ids'].tolist()
+            embedding.track_ids = saved['track_ids'].tolist()
+            embedding.sec_ids = saved['sec_ids'].tolist()
+
+        return embedding
@@ -2,24 +2,90 @@ import music21 as m21
 from typing import Union, Mapping, Sequence
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import contextlib
 import copy
+import functools
+import io
+import os
+import re
+import time
+import zipfile
+import zlib
+
+from const import SCOPE, MAX_MUSICXML_BYTES, BASIC_TABLES, STAGE_TABLES, NULLABLE_COLUMNS, DATA_DICT, DATA_TYPE_DICT, chord_kind_dict
+from schema import make_arrow_table
+
+
+def timed(stage: str):
+    "Decorator that adds the run time of a PreprocessXML method to the instance's timings[stage]"
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.time_stage(stage):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
 
-from const import SCOPE, BASIC_TABLES, NULLABLE_COLUMNS, DATA_DICT, DATA_TYPE_DICT, chord_kind_dict
 
 class PreprocessXML:
     """PreprocessXML converts a MusicXML file into a dictionary"""
 
-    def __init__(self):
-        pass
+    def __init__(self, progress_callback=None):
+        self.timings = {}  # seconds spent in each stage, see time_stage()
+        self.progress_callback = progress_callback  # called with events as processing goes, see report()
+
+
+    @contextlib.contextmanager
+    def time_stage(self, stage: str):
+        """Add the seconds spent in a with-block to self.timings[stage], and report the stage,
+        and the columns of the tables that are complete after it (see STAGE_TABLES)
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+            self.report('stage', stage=stage, seconds=seconds)
+
+        tables = {table: self.data_dict[table] for table in STAGE_TABLES.get(stage, []) if table in self.data_dict}
+        if tables:
+            self.report('tables', tables=tables)
+
+
+    def report(self, event: str, **fields) -> None:
+        "Call self.progress_callback(event, fields), if there is one"
+        if self.progress_callback is not None:
+            self.progress_callback(event, fields)
+
+        return None
 
 
     def load_data(self, mxl_filepath: str, comprehensive=False):
         # if comprehensive=False, returns basic tables. If True, returns additional tables as well
         self.mxl_filepath = mxl_filepath
-        self.comprehensive = comprehensive
+        self.timings = {}
 
         # get m21 part from mxl file
         self.part, self.part_recurse = self.load_mxl_from_file(self.mxl_filepath)
+        self.setup_data(comprehensive)
+
+
+    def load_data_from_bytes(self, mxl_bytes: bytes, comprehensive=False):
+        "Same as load_data(), but reads the contents of a .mxl (or uncompressed MusicXML) file from memory"
+        self.mxl_filepath = None
+        self.timings = {}
+
+        # get m21 part from mxl bytes
+        self.part, self.part_recurse = self.load_mxl_from_bytes(mxl_bytes)
+        self.setup_data(comprehensive)
+
+
+    @timed('setup')
+    def setup_data(self, comprehensive=False):
+        "Prepare instance variables for input_all(), once self.part has been loaded"
+        self.comprehensive = comprehensive
 
         # create instance variables
         self.artist = self.part.metadata.composer
@@ -72,21 +138,91 @@ class PreprocessXML:
 
 
     # the following class methods are all for the constructor
+    @timed('parse')
     def load_mxl_from_file(self, mxl_filepath: str, scope=SCOPE) -> Union[m21.stream.Part, m21.stream.iterator.RecursiveIterator]:
 
         if scope == 'local':
-            # create stream and extract metadata
-            s = m21.converter.parse(mxl_filepath).stripTies()
-            title = s.metadata.title
-            composer = s.metadata.composer
+            s = m21.converter.parse(mxl_filepath)
+            return self.make_part(s)
+
 
-            # create part and insert metadata
-            part = s.parts[0]
-            part.insert(0, m21.metadata.Metadata())
-            part.metadata.title = title
-            part.metadata.composer = composer
+    @timed('parse')
+    def load_mxl_from_bytes(self, mxl_bytes: bytes) -> Union[m21.stream.Part, m21.stream.iterator.RecursiveIterator]:
+        "Parse the contents of a .mxl file in memory, without writing them to disk"
+        s = m21.converter.parseData(self.extract_musicxml(mxl_bytes), format='musicxml')
+        return self.make_part(s)
+
+
+    def extract_musicxml(self, mxl_bytes: bytes) -> str:
+        """Return the MusicXML text from the bytes of a compressed .mxl file, or of an uncompressed
+        MusicXML file.  Raises a ValueError if the bytes are neither.
+        """
+        if not zipfile.is_zipfile(io.BytesIO(mxl_bytes)):
+            if b'<score-partwise' not in mxl_bytes[:4096] and b'<score-timewise' not in mxl_bytes[:4096]:
+                raise ValueError("file is not a MusicXML file")
+            return mxl_bytes.decode('utf-8')
+
+        with zipfile.ZipFile(io.BytesIO(mxl_bytes)) as archive:
+            names = archive.namelist()
+
+            # META-INF/container.xml points to the score inside the archive
+            score_name = None
+            if 'META-INF/container.xml' in names:
+                container = self.read_archive_member(archive, 'META-INF/container.xml').decode('utf-8')
+                match = re.search(r'<rootfile[^>]*full-path="([^"]+)"', container)
+                score_name = match.group(1) if match else None
+            if score_name is None:
+                xml_names = [name for name in names if name.endswith(('.xml', '.musicxml')) and not name.startswith('META-INF')]
+                if len(xml_names) == 0:
+                    raise ValueError(".mxl archive does not contain a MusicXML file")
+                score_name = xml_names[0]
+
+            return self.read_archive_member(archive, score_name).decode('utf-8')
+
+
+    def read_archive_member(self, archive: zipfile.ZipFile, name: str, max_bytes: int = MAX_MUSICXML_BYTES) -> bytes:
+        """Decompress one file of a .mxl archive, in chunks, so a small archive that expands to a
+        huge file (a zip bomb) can't exhaust memory.  Raises a ValueError if it's larger than max_bytes.
+        """
+        too_large = ValueError(f"MusicXML file is larger than {max_bytes} bytes when decompressed")
+        if archive.getinfo(name).file_size > max_bytes:
+            raise too_large
+
+        # file_size comes from the archive itself, so the decompressed bytes are counted too
+        chunks = []
+        n_bytes = 0
+        try:
+            with archive.open(name) as member:
+                while True:
+                    chunk = member.read(min(1024 * 1024, max_bytes + 1 - n_bytes))
+                    if not chunk:
+                        break
+                    n_bytes += len(chunk)
+                    if n_bytes > max_bytes:
+                        raise too_large
+                    chunks.append(chunk)
+        # corrupted data, encrypted files and unsupported compression methods
+        except (zipfile.BadZipFile, zlib.error, EOFError, RuntimeError, NotImplementedError) as e:
+            raise ValueError(f".mxl archive could not be decompressed: {e}")
 
-            return (part, part.recurse())
+        return b''.join(chunks)
+
+
+    def make_part(self, s: m21.stream.Score) -> Union[m21.stream.Part, m21.stream.iterator.RecursiveIterator]:
+        "Strip ties from the score, and return its first part with the score's metadata"
+
+        # create stream and extract metadata
+        s = s.stripTies()
+        title = s.metadata.title
+        composer = s.metadata.composer
+
+        # create part and insert metadata
+        part = s.parts[0]
+        part.insert(0, m21.metadata.Metadata())
+        part.metadata.title = title
+        part.metadata.composer = composer
+
+        return (part, part.recurse())
 
 
     def create_id_prefix(self, artist, track_name):
@@ -308,9 +444,10 @@ class PreprocessXML:
     def get_n_hps_per_section(self) -> list:
         "make a list of the number of hp's for each section"
 
-        return [np.sum(
-                    np.greater_equal(self.offset_dict['hp_start_offsets'], sec_start) & np.less(self.offset_dict['hp_start_offsets'], sec_end)
-                ) for sec_start, sec_end in zip(self.offset_dict['sec_start_offsets'], self.offset_dict['sec_end_offsets'])
+        return [
+            int(np.sum(
+                np.greater_equal(self.offset_dict['hp_start_offsets'], sec_start) & np.less(self.offset_dict['hp_start_offsets'], sec_end)
+            )) for sec_start, sec_end in zip(self.offset_dict['sec_start_offsets'], self.offset_dict['sec_end_offsets'])
         ]
 
 
@@ -1755,60 +1892,74 @@ class PreprocessXML:
     def input_all(self):
 
         # loop through part_recurse and input data into the notes and chords dictionaries
-        for ele in self.part_recurse:
-            if isinstance(ele, m21.note.Rest) or isinstance(ele, m21.note.Note):
-                self.note_rest_input(ele)
+        with self.time_stage('input_loop'):
+            # count elements first if progress is reported, to report it as a percentage
+            n_elements = sum(1 for _ in self.part_recurse) if self.progress_callback is not None else 0
+            report_every = max(1, n_elements // 20)
+
+            for i, ele in enumerate(self.part_recurse):
+                if isinstance(ele, m21.note.Rest) or isinstance(ele, m21.note.Note):
+                    self.note_rest_input(ele)
+
+                if isinstance(ele, m21.harmony.ChordSymbol) or isinstance(ele, m21.harmony.NoChord):
+                    self.chord_input(ele)
 
-            if isinstance(ele, m21.harmony.ChordSymbol) or isinstance(ele, m21.harmony.NoChord):
-                self.chord_input(ele)
+                if n_elements > 0 and (i + 1) % report_every == 0:
+                    self.report('progress', stage='input_loop', pct=round(100 * (i + 1) / n_elements, 1))
 
-        # finish inputing values into chords dictionary that we couldn't input in loop
-        self.input_chord_end_offset_info(self.data_dict['chords']['chord_start_offset'], self.track_dur, self.m1b1_factor)
+        with self.time_stage('basic_tables'):
+            # finish inputing values into chords dictionary that we couldn't input in loop
+            self.input_chord_end_offset_info(self.data_dict['chords']['chord_start_offset'], self.track_dur, self.m1b1_factor)
 
-        # input values into tracks, sections, melodic_phrases, and harmonic_phrases dictionaries
-        self.track_input()
-        self.section_input()
-        self.melodic_phrases_input()
-        self.harmonic_phrases_input()
+            # input values into tracks, sections, melodic_phrases, and harmonic_phrases dictionaries
+            self.track_input()
+            self.section_input()
+            self.melodic_phrases_input()
+            self.harmonic_phrases_input()
 
         # create additional tables if 'comprehensive' arg is set to True when class is initialized
         if self.comprehensive:
 
             # prepare dataframes
-            track_dfs = {table: pd.DataFrame(self.data_dict[table]) for table in BASIC_TABLES}
-            all_sections = track_dfs["sections"]["sec_id"].values
-            all_sections_dfs = [
-                {table: df[df["sec_id"]==sec] for table, df in track_dfs.items() if table != "tracks"}
-                for sec in all_sections
-            ]
-
-            # input values into track metrics
-            self.comprehensive_track_section_input(track_dfs, "track")
-
-            # input values into section metrics
-            for section_dfs in all_sections_dfs:
-                self.comprehensive_track_section_input(section_dfs, "section")
-            self.finish_comprehensive_section_input(track_dfs, all_sections_dfs)
+            with self.time_stage('comprehensive_prepare'):
+                track_dfs = {table: pd.DataFrame(self.data_dict[table]) for table in BASIC_TABLES}
+                all_sections = track_dfs["sections"]["sec_id"].values
+                all_sections_dfs = [
+                    {table: df[df["sec_id"]==sec] for table, df in track_dfs.items() if table != "tracks"}
+                    for sec in all_sections
+                ]
+
+            # input values into track and section metrics
+            with self.time_stage('comprehensive_sections'):
+                self.comprehensive_track_section_input(track_dfs, "track")
+                for section_dfs in all_sections_dfs:
+                    self.comprehensive_track_section_input(section_dfs, "section")
+                self.finish_comprehensive_section_input(track_dfs, all_sections_dfs)
 
             # input values into melodic phrases metrics
-            all_mps_dfs = self.prepare_all_mps_dfs(track_dfs)
-            for mp_dfs in all_mps_dfs:
-                self.comprehensive_mp_input(mp_dfs)
-            self.finish_comprehensive_mp_input(track_dfs["melodic_phrases"])
+            with self.time_stage('comprehensive_mps'):
+                all_mps_dfs = self.prepare_all_mps_dfs(track_dfs)
+                for mp_dfs in all_mps_dfs:
+                    self.comprehensive_mp_input(mp_dfs)
+                self.finish_comprehensive_mp_input(track_dfs["melodic_phrases"])
 
             # input values into harmonic phrases metrics
-            all_hps_dfs = self.prepare_all_hps_dfs(track_dfs)
-            for hp_dfs in all_hps_dfs:
-                self.comprehensive_hp_input(hp_dfs)
-            self.finish_comprehensive_hp_input(track_dfs)
+            with self.time_stage('comprehensive_hps'):
+                all_hps_dfs = self.prepare_all_hps_dfs(track_dfs)
+                for hp_dfs in all_hps_dfs:
+                    self.comprehensive_hp_input(hp_dfs)
+                self.finish_comprehensive_hp_input(track_dfs)
 
             # input values into notes metrics
-            self.comprehensive_note_input(track_dfs)
+            with self.time_stage('comprehensive_notes'):
+                self.comprehensive_note_input(track_dfs)
 
             # input values into chords metrics
-            self.comprehensive_chord_input(track_dfs)
+            with self.time_stage('comprehensive_chords'):
+                self.comprehensive_chord_input(track_dfs)
 
 
+    @timed('validate')
     def validate_input(self) -> str:
         """
         checks the following:
@@ -1866,8 +2017,42 @@ class PreprocessXML:
         return 'all values validated!'
 
 
+    # the following class methods are for exporting data_dict in columnar formats
+    def to_arrow(self, data_dict: Mapping[str, Mapping[str, list]] = None) -> Mapping[str, pa.Table]:
+        """Convert each table in data_dict to an Arrow table, using schemas made from data_type_dict.
+        data_dict defaults to self.data_dict, but can be a subset of its tables and columns.
+        """
+        data_dict = self.data_dict if data_dict is None else data_dict
+        return {
+            table: make_arrow_table(table, columns, self.data_type_dict)
+            for table, columns in data_dict.items()
+        }
+
+
+    def write_parquet(self, output_dir: str) -> list:
+        """
+        Write one Parquet file per table, to <output_dir>/<table>/<track_id>.parquet
+
+        Returns:
+        --------
+        filepaths   : list of the Parquet files written
+        """
+        import pyarrow.parquet as pq  # only needed here, so workers don't pay for importing it
+
+        track_id = self.data_dict['tracks']['track_id'][0]
+
+        filepaths = []
+        for table, arrow_table in self.to_arrow().items():
+            table_dir = os.path.join(output_dir, table)
+            os.makedirs(table_dir, exist_ok=True)
+            filepath = os.path.join(table_dir, f"{track_id}.parquet")
+            pq.write_table(arrow_table, filepath)
+            filepaths.append(filepath)
+
+        return filepaths
+
+
 if __name__ == "__main__":
-    import os
     from const import ROOT_DIR
 
     mxl_filepath = os.path.join(ROOT_DIR, "data", "pasta piece.mxl")
@@ -0,0 +1,59 @@
+"""
+Arrow schemas for the tables created by PreprocessXML.  Schemas are generated from
+DATA_TYPE_DICT and NULLABLE_COLUMNS, and id and name columns are dictionary encoded,
+since the same few values are repeated on every row.
+"""
+
+import pyarrow as pa
+from typing import Mapping
+
+from const import DATA_TYPE_DICT, NULLABLE_COLUMNS
+
+ARROW_TYPES = {
+    str: pa.string(),
+    int: pa.int64(),
+    float: pa.float64(),
+    bool: pa.bool_(),
+}
+DICTIONARY_TYPE = pa.dictionary(pa.int32(), pa.string())
+
+
+def is_dictionary_column(col_name: str, col_type: type) -> bool:
+    "id and name columns are dictionary encoded"
+    return col_type == str and (col_name.endswith('_id') or col_name.endswith('_name'))
+
+
+def make_arrow_schema(table: str, columns: list = None, data_type_dict: Mapping[str, Mapping[str, type]] = DATA_TYPE_DICT) -> pa.Schema:
+    """
+    Create an Arrow schema for one table.
+
+    Parameters:
+    -----------
+    table           : table name, e.g. 'notes'
+    columns         : optional, column names in order.  Defaults to the order of data_type_dict
+    data_type_dict  : python types for each column of each table
+    """
+    columns = list(data_type_dict[table].keys()) if columns is None else columns
+
+    fields = []
+    for col_name in columns:
+        col_type = data_type_dict[table][col_name]
+        arrow_type = DICTIONARY_TYPE if is_dictionary_column(col_name, col_type) else ARROW_TYPES[col_type]
+        fields.append(pa.field(col_name, arrow_type, nullable=(table, col_name) in NULLABLE_COLUMNS))
+
+    return pa.schema(fields, metadata={'table': table})
+
+
+def make_arrow_array(values, field: pa.Field) -> pa.Array:
+    "Convert a column to an Arrow array"
+    if pa.types.is_dictionary(field.type):
+        return pa.array(values, type=pa.string()).dictionary_encode()
+    return pa.array(values, type=field.type)
+
+
+def make_arrow_table(table: str, columns: Mapping[str, list], data_type_dict: Mapping[str, Mapping[str, type]] = DATA_TYPE_DICT) -> pa.Table:
+    "Convert one table of a PreprocessXML data_dict to an Arrow table"
+    schema = make_arrow_schema(table, list(columns.keys()), data_type_dict)
+    arrays = [make_arrow_array(columns[field.name], field) for field in schema]
+
+    return pa.Table.from_arrays(arrays, schema=schema)
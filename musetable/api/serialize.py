@@ -0,0 +1,130 @@
+"""
+Serialize PreprocessXML output for API responses.
+
+JSON responses are encoded with orjson, which handles NumPy types natively, and every
+response body can be compressed with gzip or zstd, depending on Accept-Encoding.
+
+Arrow IPC responses are a sequence of Arrow IPC streams, one per table, written back
+to back.  Each stream holds a single record batch, and its schema metadata holds the
+table name ('table') and the names of all tables in the response ('tables').  Use
+read_arrow_ipc() (or pa.ipc.open_stream() in a loop) to read them back.
+"""
+
+import gzip
+import orjson
+import pyarrow as pa
+from typing import Mapping, Optional, Sequence
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional, gzip is always available
+    zstandard = None
+
+ARROW_STREAM_MEDIA_TYPE = 'application/vnd.apache.arrow.stream'
+JSON_MEDIA_TYPE = 'application/json'
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+EVENT_STREAM_MEDIA_TYPE = 'text/event-stream'
+MIN_COMPRESS_BYTES = 1024  # smaller bodies aren't worth compressing
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def project_tables(data_dict: Mapping[str, Mapping[str, list]], tables: Sequence[str] = None, columns: Sequence[str] = None) -> dict:
+    """
+    Select a subset of tables and columns from a data_dict.
+
+    Parameters:
+    -----------
+    data_dict   : data_dict of a PreprocessXML instance
+    tables      : optional, table names to keep.  Defaults to all tables
+    columns     : optional, columns to keep, as 'table.column'.  Tables without any columns
+                  listed keep all their columns
+
+    Returns:
+    --------
+    projected   : data_dict with only the selected tables and columns.  Raises a KeyError
+                  for unknown tables or columns
+    """
+    tables = list(data_dict.keys()) if not tables else list(tables)
+    for table in tables:
+        if table not in data_dict:
+            raise KeyError(f"unknown table '{table}'")
+
+    selected_columns = {}
+    for column in columns or []:
+        table, _, col_name = column.partition('.')
+        if table not in data_dict or col_name not in data_dict[table]:
+            raise KeyError(f"unknown column '{column}'")
+        selected_columns.setdefault(table, []).append(col_name)
+
+    return {
+        table: {col_name: data_dict[table][col_name] for col_name in selected_columns.get(table, data_dict[table].keys())}
+        for table in tables
+    }
+
+
+def to_json(data) -> bytes:
+    "Encode data as JSON.  NumPy arrays and scalars are encoded natively, NaN becomes null"
+    return orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+
+
+def format_event(event: str, data) -> bytes:
+    "Format a server-sent event, with data encoded as JSON"
+    return b"event: " + event.encode() + b"\ndata: " + to_json(data) + b"\n\n"
+
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    "Pick 'zstd' or 'gzip' from an Accept-Encoding header, or None for no compression"
+    accepted = set()
+    for item in accept_encoding.lower().split(','):
+        encoding, _, params = item.partition(';')
+        name, _, quality = params.partition('=')
+        if name.strip() == 'q':
+            try:
+                if float(quality) == 0:  # q=0 means "not acceptable"
+                    continue
+            except ValueError:
+                continue
+        accepted.add(encoding.strip())
+
+    if zstandard is not None and 'zstd' in accepted:
+        return 'zstd'
+    if 'gzip' in accepted or '*' in accepted:
+        return 'gzip'
+    return None
+
+
+def compress(body: bytes, encoding: Optional[str]) -> bytes:
+    "Compress a response body with the encoding returned by choose_encoding()"
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=GZIP_LEVEL)
+    return body
+
+
+def to_arrow_ipc(arrow_tables: Mapping[str, pa.Table]) -> bytes:
+    "Write a dict of Arrow tables as consecutive IPC streams, one record batch per table"
+    table_names = ','.join(arrow_tables.keys())
+    sink = pa.BufferOutputStream()
+
+    for table, arrow_table in arrow_tables.items():
+        metadata = dict(arrow_table.schema.metadata or {})
+        metadata.update({b'table': table.encode(), b'tables': table_names.encode()})
+        arrow_table = arrow_table.combine_chunks().replace_schema_metadata(metadata)
+        with pa.ipc.new_stream(sink, arrow_table.schema) as writer:
+            writer.write_table(arrow_table)
+
+    return sink.getvalue().to_pybytes()
+
+
+def read_arrow_ipc(data: bytes) -> Mapping[str, pa.Table]:
+    "Read the response of to_arrow_ipc() back into a dict of Arrow tables"
+    reader = pa.BufferReader(data)
+
+    arrow_tables = {}
+    while reader.tell() < reader.size():
+        stream = pa.ipc.open_stream(reader)
+        arrow_tables[stream.schema.metadata[b'table'].decode()] = stream.read_all()
+
+    return arrow_tables
@@ -0,0 +1,154 @@
+"""
+Chord transition count matrices for each section, each track, and the whole corpus.
+Two matrices are kept at every level:
+    - root: 12 x 12 counts of root pitch class -> next root pitch class ('chord_root_pc')
+    - kind: counts of chord kind -> next chord kind ('chord_kind'), in CHORD_KINDS order
+The corpus matrices are updated incrementally by adding or subtracting one track's
+counts, so Markov-style questions can be answered without aggregating the chords table.
+
+Example:
+    transitions = ChordTransitions()
+    transitions.add_file(mxl_filepath)
+    probs = transitions.transition_probabilities(transitions.corpus_kind)
+    probs[CHORD_KIND_INDEX['dominant'], CHORD_KIND_INDEX['major']]
+"""
+
+import numpy as np
+from typing import Mapping, Sequence
+
+from const import chord_kind_dict
+
+N_PITCH_CLASSES = 12
+CHORD_KINDS = [kind for kinds in chord_kind_dict.values() for kind in kinds]
+CHORD_KIND_INDEX = {kind: i for i, kind in enumerate(CHORD_KINDS)}
+
+
+class ChordTransitions:
+    "ChordTransitions keeps root and chord kind transition counts per section, track and corpus"
+
+    def __init__(self):
+        self.sections = {}  # sec_id -> (root matrix, kind matrix)
+        self.tracks = {}  # track_id -> (root matrix, kind matrix)
+        self.track_sections = {}  # track_id -> list of sec_ids
+        self.corpus_root = np.zeros((N_PITCH_CLASSES, N_PITCH_CLASSES), dtype=np.int32)
+        self.corpus_kind = np.zeros((len(CHORD_KINDS), len(CHORD_KINDS)), dtype=np.int32)
+
+
+    def count_transitions(self, root_pcs: Sequence[int], kinds: Sequence[str]) -> tuple:
+        """Return (root matrix, kind matrix) for a sequence of chords.  Transitions to or from
+        N.C. (root pitch class -1) are left out of the root matrix.
+        """
+        root_pcs = np.asarray(root_pcs, dtype=np.int64)
+        kind_idxs = np.array([CHORD_KIND_INDEX.get(kind, CHORD_KIND_INDEX['other']) for kind in kinds], dtype=np.int64)
+
+        has_root = (root_pcs[:-1] >= 0) & (root_pcs[1:] >= 0)
+        root_matrix = np.zeros((N_PITCH_CLASSES, N_PITCH_CLASSES), dtype=np.int32)
+        np.add.at(root_matrix, (root_pcs[:-1][has_root], root_pcs[1:][has_root]), 1)
+
+        kind_matrix = np.zeros((len(CHORD_KINDS), len(CHORD_KINDS)), dtype=np.int32)
+        np.add.at(kind_matrix, (kind_idxs[:-1], kind_idxs[1:]), 1)
+
+        return (root_matrix, kind_matrix)
+
+
+    def add_track(self, data_dict: Mapping[str, Mapping[str, list]]) -> None:
+        """Add (or replace) the transition counts of one track.  data_dict is the data_dict of
+        a PreprocessXML instance after input_all() has been run.
+        """
+        track_id = data_dict['tracks']['track_id'][0]
+        self.remove_track(track_id)
+
+        chords = data_dict['chords']
+        root_pcs = np.array(chords['chord_root_pc'])
+        kinds = np.array(chords['chord_kind'], dtype=object)
+        sec_ids = np.array(chords['sec_id'], dtype=object)
+
+        # track counts include transitions across sections, section counts don't
+        self.tracks[track_id] = self.count_transitions(root_pcs, kinds)
+        self.track_sections[track_id] = []
+        for sec_id in data_dict['sections']['sec_id']:
+            in_section = sec_ids == sec_id
+            self.sections[sec_id] = self.count_transitions(root_pcs[in_section], kinds[in_section])
+            self.track_sections[track_id].append(sec_id)
+
+        track_root, track_kind = self.tracks[track_id]
+        self.corpus_root += track_root
+        self.corpus_kind += track_kind
+
+        return None
+
+
+    def add_file(self, mxl_filepath: str) -> None:
+        "Preprocess a MusicXML file and add its transition counts"
+        from preprocess import PreprocessXML  # only import music21 when files are processed
+
+        preproc = PreprocessXML()
+        preproc.load_data(mxl_filepath, comprehensive=False)
+        preproc.input_all()
+        self.add_track(preproc.data_dict)
+
+        return None
+
+
+    def remove_track(self, track_id: str) -> None:
+        "Subtract a track's counts from the corpus, and drop its track and section matrices"
+        if track_id not in self.tracks:
+            return None
+
+        track_root, track_kind = self.tracks.pop(track_id)
+        self.corpus_root -= track_root
+        self.corpus_kind -= track_kind
+        for sec_id in self.track_sections.pop(track_id):
+            self.sections.pop(sec_id, None)
+
+        return None
+
+
+    def transition_probabilities(self, counts: np.ndarray) -> np.ndarray:
+        "Normalize each row of a count matrix, so row i is P(next | current = i)"
+        totals = counts.sum(axis=1, keepdims=True)
+        return np.divide(counts, totals, out=np.zeros(counts.shape, dtype=np.float64), where=totals > 0)
+
+
+    def root_movement_counts(self, root_matrix: np.ndarray) -> np.ndarray:
+        "Collapse a root matrix into counts of root movement in half steps up (0 - 11), i.e. key invariant"
+        from_pc, to_pc = np.indices(root_matrix.shape)
+        movements = ((to_pc - from_pc) % N_PITCH_CLASSES).ravel()
+        return np.bincount(movements, weights=root_matrix.ravel(), minlength=N_PITCH_CLASSES).astype(np.int64)
+
+
+    def save(self, filepath: str) -> None:
+        "Save all matrices to a .npz file"
+        track_ids = list(self.tracks.keys())
+        sec_ids = [sec_id for track_id in track_ids for sec_id in self.track_sections[track_id]]
+        np.savez_compressed(
+            filepath,
+            corpus_root=self.corpus_root,
+            corpus_kind=self.corpus_kind,
+            track_ids=np.array(track_ids, dtype=str),
+            track_root=np.array([self.tracks[t][0] for t in track_ids], dtype=np.int32).reshape(-1, N_PITCH_CLASSES, N_PITCH_CLASSES),
+            track_kind=np.array([self.tracks[t][1] for t in track_ids], dtype=np.int32).reshape(-1, len(CHORD_KINDS), len(CHORD_KINDS)),
+            sec_ids=np.array(sec_ids, dtype=str),
+            sec_track_ids=np.array([track_id for track_id in track_ids for _ in self.track_sections[track_id]], dtype=str),
+            sec_root=np.array([self.sections[s][0] for s in sec_ids], dtype=np.int32).reshape(-1, N_PITCH_CLASSES, N_PITCH_CLASSES),
+            sec_kind=np.array([self.sections[s][1] for s in sec_ids], dtype=np.int32).reshape(-1, len(CHORD_KINDS), len(CHORD_KINDS)),
+        )
+
+        return None
+
+
+    @classmethod
+    def load(cls, filepath: str):
+        "Load matrices saved with save()"
+        transitions = cls()
+        with np.load(filepath) as saved:
+            transitions.corpus_root = saved['corpus_root']
+            transitions.corpus_kind = saved['corpus_kind']
+            for track_id, root, kind in zip(saved['track_ids'].tolist(), saved['track_root'], saved['track_kind']):
+                transitions.tracks[track_id] = (root, kind)
+                transitions.track_sections[track_id] = []
+            for sec_id, track_id, root, kind in zip(saved['sec_ids'].tolist(), saved['sec_track_ids'].tolist(), saved['sec_root'], saved['sec_kind']):
+                transitions.sections[sec_id] = (root, kind)
+                transitions.track_sections[track_id].append(sec_id)
+
+        return transitions
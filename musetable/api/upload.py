@@ -0,0 +1,65 @@
+"""
+Read uploaded .mxl files from a request body, entirely in memory.  Uploads can be sent
+either as the raw request body, or as multipart/form-data with one or more file fields.
+"""
+
+import email.parser
+import email.policy
+from fastapi import HTTPException, Request
+from typing import List, Tuple
+
+from const import MAX_UPLOAD_BYTES
+
+
+async def read_body(request: Request, max_bytes: int = None) -> bytes:
+    "Read the request body, stopping with a 413 error as soon as it's larger than max_bytes (default MAX_UPLOAD_BYTES)"
+    max_bytes = MAX_UPLOAD_BYTES if max_bytes is None else max_bytes
+
+    content_length = request.headers.get("content-length")
+    if content_length is not None and content_length.isdigit() and int(content_length) > max_bytes:
+        raise HTTPException(status_code=413, detail=f"request body is larger than {max_bytes} bytes")
+
+    chunks = []
+    n_bytes = 0
+    async for chunk in request.stream():
+        n_bytes += len(chunk)
+        if n_bytes > max_bytes:
+            raise HTTPException(status_code=413, detail=f"request body is larger than {max_bytes} bytes")
+        chunks.append(chunk)
+
+    return b"".join(chunks)
+
+
+def extract_files(body: bytes, content_type: str) -> List[Tuple[str, bytes]]:
+    """
+    Return a list of (filename, file bytes) from a request body.  A multipart/form-data body
+    can hold any number of files.  Any other body is treated as the bytes of a single file.
+    """
+    if not content_type.lower().startswith("multipart/form-data"):
+        return [("upload.mxl", body)] if len(body) > 0 else []
+
+    # parse the multipart body with the standard library's MIME parser, which stays in memory
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+        b"Content-Type: " + content_type.encode("latin-1") + b"\r\n\r\n" + body
+    )
+    if not message.is_multipart():
+        raise HTTPException(status_code=400, detail="could not parse multipart body")
+
+    files = []
+    for part in message.iter_parts():
+        filename = part.get_filename()
+        if filename is None:  # form fields that aren't files
+            continue
+        files.append((filename, part.get_payload(decode=True)))
+
+    return files
+
+
+async def read_upload_files(request: Request, max_bytes: int = None) -> List[Tuple[str, bytes]]:
+    "Read every uploaded file of a request, raising a 400 error if there are none"
+    body = await read_body(request, max_bytes)
+    files = extract_files(body, request.headers.get("content-type", ""))
+    if len(files) == 0:
+        raise HTTPException(status_code=400, detail="no file was uploaded")
+
+    return files
@@ -0,0 +1,87 @@
+"""
+Warm up a worker process before it takes requests: import music21 and the parser, then run
+a tiny embedded lead sheet through PreprocessXML, so music21's environment, parsers and
+chord-symbol tables are initialized on startup rather than by the first request.
+"""
+
+import time
+
+from const import chord_kind_dict
+
+# four measures in two sections, with the marks PreprocessXML needs: a rehearsal mark (sections), slurs
+# (melodic phrases), 'hp' text expressions (harmonic phrases) and chord symbols
+WARMUP_MUSICXML = """<?xml version="1.0" encoding="UTF-8"?>
+<score-partwise version="4.0">
+  <work><work-title>Warm Up</work-title></work>
+  <identification><creator type="composer">musetable</creator></identification>
+  <part-list><score-part id="P1"><part-name>Lead</part-name></score-part></part-list>
+  <part id="P1">
+    <measure number="1">
+      <attributes>
+        <divisions>1</divisions>
+        <key><fifths>0</fifths></key>
+        <time><beats>4</beats><beat-type>4</beat-type></time>
+        <clef><sign>G</sign><line>2</line></clef>
+      </attributes>
+      <direction placement="above"><direction-type><rehearsal>Verse</rehearsal></direction-type></direction>
+      <direction placement="below"><direction-type><words>hp</words></direction-type></direction>
+      <harmony><root><root-step>C</root-step></root><kind>major</kind></harmony>
+      <note><pitch><step>C</step><octave>4</octave></pitch><duration>1</duration><type>quarter</type><notations><slur type="start" number="1"/></notations></note>
+      <note><pitch><step>D</step><octave>4</octave></pitch><duration>1</duration><type>quarter</type></note>
+      <note><rest/><duration>1</duration><type>quarter</type></note>
+      <note><pitch><step>G</step><octave>4</octave></pitch><duration>1</duration><type>quarter</type><notations><slur type="stop" number="1"/></notations></note>
+    </measure>
+    <measure number="2">
+      <direction placement="below"><direction-type><words>hp</words></direction-type></direction>
+      <harmony><root><root-step>G</root-step></root><kind>dominant</kind></harmony>
+      <note><pitch><step>F</step><octave>4</octave></pitch><duration>2</duration><type>half</type><notations><slur type="start" number="1"/></notations></note>
+      <note><pitch><step>E</step><octave>4</octave></pitch><duration>2</duration><type>half</type><notations><slur type="stop" number="1"/></notations></note>
+    </measure>
+    <measure number="3">
+      <direction placement="above"><direction-type><rehearsal>Chorus</rehearsal></direction-type></direction>
+      <direction placement="below"><direction-type><words>hp</words></direction-type></direction>
+      <harmony><root><root-step>A</root-step></root><kind>minor-seventh</kind></harmony>
+      <note><pitch><step>A</step><octave>4</octave></pitch><duration>1</duration><type>quarter</type><notations><slur type="start" number="1"/></notations></note>
+      <note><rest/><duration>1</duration><type>quarter</type></note>
+      <note><pitch><step>C</step><octave>5</octave></pitch><duration>2</duration><type>half</type></note>
+    </measure>
+    <measure number="4">
+      <harmony><root><root-step>F</root-step></root><kind>major-seventh</kind></harmony>
+      <note><pitch><step>B</step><octave>4</octave></pitch><duration>2</duration><type>half</type></note>
+      <note><pitch><step>C</step><octave>5</octave></pitch><duration>2</duration><type>half</type><notations><slur type="stop" number="1"/></notations></note>
+    </measure>
+  </part>
+</score-partwise>
+"""
+
+
+def warm_up(comprehensive: bool = True) -> dict:
+    """
+    Import the parser and process the embedded lead sheet.  Returns the seconds spent
+    importing, processing, and building chord symbols of every kind in chord_kind_dict.
+    """
+    report = {}
+
+    start = time.perf_counter()
+    from preprocess import PreprocessXML
+    import music21 as m21
+    report['import_seconds'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    preproc = PreprocessXML()
+    preproc.load_data_from_bytes(WARMUP_MUSICXML.encode(), comprehensive)
+    preproc.input_all()
+    report['validation_message'] = preproc.validate_input()
+    report['preprocess_seconds'] = time.perf_counter() - start
+
+    # music21 builds the pitches of each chord kind the first time it's realized
+    start = time.perf_counter()
+    for kinds in chord_kind_dict.values():
+        for kind in kinds:
+            try:
+                m21.harmony.ChordSymbol(root='C', kind=kind).pitches
+            except Exception:  # a kind music21 can't realize on its own is fine to skip here
+                continue
+    report['chord_symbols_seconds'] = time.perf_counter() - start
+
+    return report
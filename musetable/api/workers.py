@@ -0,0 +1,256 @@
+"""
+Run PreprocessXML jobs in a pool of worker processes.  music21 holds the GIL for the
+whole run, so preprocessing in the API's threadpool would stall every other request of
+the same uvicorn worker.  Each worker process imports music21 once, when it starts.
+"""
+
+import asyncio
+import cProfile
+import functools
+import multiprocessing
+import os
+import pstats
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable
+
+from const import MAX_WORKERS, JOB_TIMEOUT
+
+VALIDATED_MESSAGE = "all values validated!"
+PROFILE_LIMIT = 100  # functions listed in a profile report
+warm_up_report = {}  # of this worker process, see init_worker()
+
+
+def init_worker() -> None:
+    "Import music21 and the parser once per worker process and warm them up, before the first job arrives"
+    from warmup import warm_up
+
+    try:
+        warm_up_report.update(warm_up())
+    except Exception as e:  # a worker that couldn't warm up can still take jobs
+        warm_up_report['error'] = f"{type(e).__name__}: {e}"
+
+    return None
+
+
+def get_warm_up_report() -> dict:
+    "Return the warm-up report of the worker process that runs this"
+    return {'pid': os.getpid(), **warm_up_report}
+
+
+def preprocess_job(comprehensive: bool, mxl_filepath: str = None, mxl_bytes: bytes = None, progress_callback: Callable = None) -> dict:
+    """
+    Load a MusicXML file from a filepath or from memory, input all data and validate it.
+    Runs in a worker process, so only picklable results are returned.  progress_callback is
+    passed to PreprocessXML.
+
+    Returns:
+    --------
+    result  : dict with keys 'data_dict', 'data_type_dict', 'validation_message', 'timings'
+              (seconds per stage, see PreprocessXML.time_stage()), 'n_notes' and 'n_chords'
+    """
+    from preprocess import PreprocessXML
+
+    preproc = PreprocessXML(progress_callback)
+    if mxl_bytes is not None:
+        preproc.load_data_from_bytes(mxl_bytes, comprehensive)
+    else:
+        preproc.load_data(mxl_filepath, comprehensive)
+    preproc.input_all()
+    validation_message = preproc.validate_input()
+
+    return {
+        'data_dict': preproc.data_dict,
+        'data_type_dict': preproc.data_type_dict,
+        'validation_message': validation_message,
+        'timings': preproc.timings,
+        'n_notes': len(preproc.data_dict['notes']['note_id']),
+        'n_chords': len(preproc.data_dict['chords']['chord_id']),
+    }
+
+
+def stream_job(queue, comprehensive: bool, mxl_filepath: str = None, mxl_bytes: bytes = None) -> dict:
+    """
+    Same as preprocess_job(), but also puts progress events on queue (a multiprocessing manager
+    queue) as (event, fields) tuples: 'stage' and 'progress' events, and a 'table' event with
+    the columns of each table as soon as it's complete.  None is put on the queue at the end.
+    """
+    def progress_callback(event: str, fields: dict) -> None:
+        if event == 'tables':
+            for table, columns in fields['tables'].items():
+                queue.put(('table', {'table': table, 'columns': columns}))
+        else:
+            queue.put((event, fields))
+
+    try:
+        return preprocess_job(comprehensive, mxl_filepath=mxl_filepath, mxl_bytes=mxl_bytes, progress_callback=progress_callback)
+    finally:
+        queue.put(None)
+
+
+def profile_job(comprehensive: bool, mxl_filepath: str = None, mxl_bytes: bytes = None, limit: int = PROFILE_LIMIT) -> dict:
+    """
+    Same as preprocess_job(), under cProfile.  The result also has a 'profile' key, with the
+    total profiled seconds and the limit functions with the highest cumulative time,
+    including music21's.
+    """
+    profiler = cProfile.Profile()
+    result = profiler.runcall(preprocess_job, comprehensive, mxl_filepath=mxl_filepath, mxl_bytes=mxl_bytes)
+
+    stats = pstats.Stats(profiler)
+    functions = []
+    for (filename, line_num, func_name), (_, n_calls, tottime, cumtime, _) in stats.stats.items():
+        functions.append({
+            'function': f"{filename}:{line_num}({func_name})",
+            'ncalls': n_calls,
+            'tottime': tottime,
+            'cumtime': cumtime,
+        })
+    functions.sort(key=lambda function: function['cumtime'], reverse=True)
+    result['profile'] = {'total_seconds': stats.total_tt, 'functions': functions[:limit]}
+
+    return result
+
+
+class WorkerPool:
+    """
+    WorkerPool runs functions in a bounded pool of processes from async code.  Jobs wait for a
+    free worker in the event loop rather than in the executor's queue, so their timeout only
+    counts processing.  When a job times out or a worker dies, its executor is retired: new jobs
+    go to fresh workers, and the old processes are killed once their other jobs have finished.
+    """
+
+    def __init__(self, max_workers: int = MAX_WORKERS, timeout: float = JOB_TIMEOUT):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.executor = None
+        self.manager = None  # serves the queues of stream_job()
+        self.n_pending = 0  # jobs submitted and not finished yet, including those waiting for a worker
+        self.slots = None  # semaphore of free workers, made in the running event loop
+        self.slots_loop = None
+        self.starting = None  # warm-up of workers started by run()
+        self.executor_jobs = {}  # executor: number of jobs running in it
+        self.retired = []  # executors with a stuck or dead worker
+
+
+    def start(self) -> None:
+        "Start the worker processes.  Workers are started with 'spawn', which is safe in a threaded server"
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=init_worker,
+            )
+
+        return None
+
+
+    def shutdown(self, wait: bool = True) -> None:
+        "Stop the worker processes"
+        if self.executor is not None:
+            self.executor.shutdown(wait=wait)
+            self.executor = None
+        for executor in list(self.retired):
+            self.kill_executor(executor)
+        if self.manager is not None:
+            self.manager.shutdown()
+            self.manager = None
+
+        return None
+
+
+    async def warm_up(self) -> list:
+        """Start the worker processes and wait until all of them have warmed up (see init_worker()).
+        Returns the warm-up report of each worker.
+        """
+        self.start()
+        loop = asyncio.get_running_loop()
+        # jobs submitted while every worker is busy starting start another worker
+        futures = [loop.run_in_executor(self.executor, get_warm_up_report) for _ in range(self.max_workers)]
+        reports = await asyncio.gather(*futures)
+
+        return list({report['pid']: report for report in reports}.values())
+
+
+    def start_manager(self) -> None:
+        "Start the manager process that serves the queues of stream_job()"
+        if self.manager is None:
+            self.manager = multiprocessing.get_context('spawn').Manager()
+
+        return None
+
+
+    def make_queue(self):
+        "Make a queue that worker processes can put events on, for stream_job()"
+        self.start_manager()
+        return self.manager.Queue()
+
+
+    def get_slots(self) -> asyncio.Semaphore:
+        "Return the semaphore of free workers of the running event loop"
+        loop = asyncio.get_running_loop()
+        if self.slots_loop is not loop:
+            self.slots = asyncio.Semaphore(self.max_workers)
+            self.slots_loop = loop
+
+        return self.slots
+
+
+    async def ensure_started(self) -> None:
+        "Start and warm up the workers if they aren't running, so a job's timeout doesn't count the warm-up"
+        if self.executor is None:
+            self.starting = asyncio.ensure_future(self.warm_up())
+        if self.starting is not None and not self.starting.done():
+            await asyncio.shield(self.starting)
+
+        return None
+
+
+    def kill_executor(self, executor: ProcessPoolExecutor) -> None:
+        "Kill the processes of a retired executor"
+        for process in list((executor._processes or {}).values()):  # no public API lists an executor's processes
+            process.terminate()
+        executor.shutdown(wait=False)
+        self.retired.remove(executor)
+        self.executor_jobs.pop(executor, None)
+
+        return None
+
+
+    def finish_job(self, executor: ProcessPoolExecutor, failed: bool) -> None:
+        "Count a job out of its executor, and retire the executor if the job left a worker stuck or dead"
+        self.executor_jobs[executor] -= 1
+        if failed and executor is self.executor:
+            self.executor = None  # the next job starts fresh workers
+            self.retired.append(executor)
+        if executor in self.retired and self.executor_jobs[executor] == 0:
+            self.kill_executor(executor)
+
+        return None
+
+
+    async def run(self, func: Callable, *args, timeout: float = None, **kwargs):
+        """Run func(*args, **kwargs) in a worker process once one is free.  Raises asyncio.TimeoutError
+        if it runs longer than timeout seconds (default self.timeout), not counting the wait for
+        a worker, and the worker running it is killed.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        loop = asyncio.get_running_loop()
+
+        self.n_pending += 1
+        try:
+            async with self.get_slots():
+                await self.ensure_started()
+                executor = self.executor
+                self.executor_jobs[executor] = self.executor_jobs.get(executor, 0) + 1
+                failed = False
+                try:
+                    future = loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+                    return await asyncio.wait_for(future, timeout=timeout)
+                except (asyncio.TimeoutError, BrokenProcessPool):
+                    failed = True
+                    raise
+                finally:
+                    self.finish_job(executor, failed)
+        finally:
+            self.n_pending -= 1
@@ -0,0 +1,5 @@
+import sys
+
+from musetable_db.ingest import main
+
+sys.exit(main())
@@ -15,3 +15,27 @@ PLAYLIST_NAME = "Your Top Songs 2022"
 # for database secrets
 SECRET_ID = "musetable_auth"
 VERSION_ID = 1
+
+# database tables, in the order of PreprocessXML.stream_to_dict (parent tables first)
+TABLE_NAMES = ["tracks", "sections", "phrases", "notes", "harmony"]
+TABLE_KEYS = {"tracks": ["id"], "sections": ["id"]}  # tables upserted on their keys, the others are replaced by section_id
+
+# foreign keys, all ON DELETE CASCADE: constraint name: (table, column, referenced table)
+FOREIGN_KEYS = {
+    "sections_track_id_fkey": ("sections", "track_id", "tracks"),
+    "phrases_section_id_fkey": ("phrases", "section_id", "sections"),
+    "notes_section_id_fkey": ("notes", "section_id", "sections"),
+    "harmony_section_id_fkey": ("harmony", "section_id", "sections"),
+}
+
+# secondary indexes managed by DatabaseControl: index name: (table, columns)
+INDEXES = {
+    "sections_track_id_idx": ("sections", ["track_id"]),
+    "phrases_section_id_idx": ("phrases", ["section_id"]),
+    "notes_section_id_offset_ql_idx": ("notes", ["section_id", "offset_ql"]),  # also serves lookups on section_id alone
+    "harmony_section_id_idx": ("harmony", ["section_id"]),
+}
+
+# for the database connection pool
+DB_MIN_CONNECTIONS = int(os.environ.get("MUSETABLE_DB_MIN_CONNECTIONS", 1))
+DB_MAX_CONNECTIONS = int(os.environ.get("MUSETABLE_DB_MAX_CONNECTIONS", 8))
@@ -7,12 +7,12 @@ TODO:
 
 import psycopg2
 from psycopg2 import sql
-from musetable_db.db_decorator import PostgresDB
-import re
+from contextlib import contextmanager
+from musetable_db.db_decorator import db
+from musetable_db.preprocess import clear_tables_cache
 
-from musetable_db.const import PROJECT_ID, SECRET_ID, VERSION_ID
+from musetable_db.const import FOREIGN_KEYS, INDEXES
 
-db = PostgresDB(PROJECT_ID, SECRET_ID, VERSION_ID)
 
 class DatabaseControl:
     """
@@ -55,6 +55,7 @@ class DatabaseControl:
             sql_file = file.read()
         try:
             cursor.execute(sql_file)
+            clear_tables_cache()
             print(f"Tables created using file {sql_filepath}!")
         except (Exception, psycopg2.Error) as error:
             print(f"Error while creating tables using file {sql_filepath}:", error)
@@ -78,6 +79,7 @@ class DatabaseControl:
             except (Exception, psycopg2.Error) as error:
                 print(f"Error while deleting tables:", error)
 
+        clear_tables_cache()
         if count == len(tables):
             print("All tables deleted, boss!")
 
@@ -123,74 +125,149 @@ class DatabaseControl:
 
     @db.with_cursor
     def delete_all_values_all_tables(self, cursor):
-        table_query = "SELECT table_name FROM information_schema.tables WHERE table_schema = 'public'"
+        table_query = "SELECT table_name FROM information_schema.tables WHERE table_schema = 'public' AND table_type = 'BASE TABLE'"
         cursor.execute(table_query)
         table_names = [t[0] for t in cursor.fetchall()]
+        if not table_names:
+            return None
 
-        for table_name in table_names[::-1]:
-            delete_query = sql.SQL("DELETE FROM {table} CASCADE").format(
-                table=sql.Identifier(table_name)
-            )
-            try:
-                cursor.execute(delete_query)
-
-            except psycopg2.errors.ForeignKeyViolation as e:
-
-                # get names of child table and constraint
-                match = re.search(r'"(\w+)"', e.pgerror)
-                if match:
-                    child_table = match.group(1)
-                match = re.search(r'"(\w+)"', e.pgcode)
-                if match:
-                    constraint_name = match.group(1)
-
-                # remove the foreign key constraint
-                fk_query = sql.SQL("ALTER TABLE {} DROP CONSTRAINT {};").format(
-                    sql.Identifier(child_table),
-                    sql.Identifier(constraint_name)
-                )
-                cursor.execute(fk_query)
-
-                # delete
-                cursor.execute(delete_query)
+        # one statement empties every table, so foreign keys never have to be dropped
+        truncate_query = sql.SQL("TRUNCATE {tables} CASCADE").format(
+            tables=sql.SQL(', ').join(map(sql.Identifier, table_names))
+        )
+        try:
+            cursor.execute(truncate_query)
+            print("all data deleted, boss!")
+        except (Exception, psycopg2.Error) as error:
+            print(f"Error while deleting all values:", error)
 
-        print("all data deleted, boss!")
+    @db.with_cursor
+    def delete_sections(self, cursor, section_ids):
+        """
+        Delete sections by id in one statement.  Their phrases, notes and harmony are deleted
+        by the ON DELETE CASCADE foreign keys, in the same transaction.
+        """
+        query = "DELETE FROM sections WHERE id = ANY(%s)"
+        try:
+            cursor.execute(query, (list(section_ids),))
+            print(f"{cursor.rowcount} sections deleted, with their phrases, notes and harmony")
+        except (Exception, psycopg2.Error) as error:
+            print(f"Error while deleting sections {list(section_ids)}:", error)
 
     @db.with_cursor
-    def delete_all_values_by_section_id(self, cursor, section_id):
-
-        # get tables with section_id columns
-        table_query = """
-        SELECT t.table_name
-        FROM information_schema.tables t
-        INNER JOIN information_schema.columns c ON c.table_name = t.table_name
-        WHERE c.column_name = 'section_id'
-            AND t.table_schema = 'public'
+    def delete_tracks(self, cursor, track_ids):
+        "Delete tracks by id in one statement, cascading to their sections and the sections' rows"
+        query = "DELETE FROM tracks WHERE id = ANY(%s)"
+        try:
+            cursor.execute(query, (list(track_ids),))
+            print(f"{cursor.rowcount} tracks deleted, with their sections")
+        except (Exception, psycopg2.Error) as error:
+            print(f"Error while deleting tracks {list(track_ids)}:", error)
+
+    def delete_all_values_by_section_id(self, section_id):
+        self.delete_sections([section_id])
+
+    def add_cascading_foreign_keys(self):
         """
-        cursor.execute(table_query)
-        table_names = [t[0] for t in cursor.fetchall()]
+        Recreate the foreign keys in FOREIGN_KEYS with ON DELETE CASCADE, for databases created
+        before create_db_tables_pg.sql declared them that way.  Runs in one transaction.
+        """
+        try:
+            with db.transaction() as cursor:
+                for constraint_name, (table_name, column_name, parent_table) in FOREIGN_KEYS.items():
+                    query = sql.SQL(
+                        "ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {constraint}, "
+                        "ADD CONSTRAINT {constraint} FOREIGN KEY ({column}) REFERENCES {parent} (id) ON DELETE CASCADE"
+                    ).format(
+                        table=sql.Identifier(table_name),
+                        constraint=sql.Identifier(constraint_name),
+                        column=sql.Identifier(column_name),
+                        parent=sql.Identifier(parent_table)
+                    )
+                    cursor.execute(query)
+            print("Foreign keys now cascade on delete")
+        except (Exception, psycopg2.Error) as error:
+            print(f"Error while adding cascading foreign keys:", error)
 
-        # delete section_id rows from child tables of 'sections' table
-        for table_name in table_names:
-            child_delete_query = sql.SQL("DELETE FROM {table} WHERE section_id = {sec_id};").format(
+
+    @db.with_cursor
+    def list_indexes(self, cursor):
+        query = "SELECT tablename, indexname, indexdef FROM pg_indexes WHERE schemaname = 'public' ORDER BY tablename, indexname"
+        try:
+            cursor.execute(query)
+            print("Indexes in database:")
+            for table_name, index_name, index_def in cursor.fetchall():
+                print(f"- {table_name}.{index_name}: {index_def}")
+        except (Exception, psycopg2.Error) as error:
+            print(f"Error while listing indexes:", error)
+
+
+    @db.with_cursor
+    def create_indexes(self, cursor, indexes=None, concurrently=False):
+        """
+        Create the secondary indexes in INDEXES, or in indexes (same format), that don't exist
+        yet.  With concurrently, the tables stay writable while the indexes are built, which
+        takes longer.
+        """
+        indexes = INDEXES if indexes is None else indexes
+
+        # a failed concurrent build leaves an invalid index behind, which IF NOT EXISTS would keep
+        invalid_query = """
+        SELECT c.relname
+        FROM pg_index i
+        INNER JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE NOT i.indisvalid
+        """
+        cursor.execute(invalid_query)
+        invalid_indexes = [row[0] for row in cursor.fetchall() if row[0] in indexes]
+        for index_name in invalid_indexes:
+            cursor.execute(sql.SQL("DROP INDEX IF EXISTS {index}").format(index=sql.Identifier(index_name)))
+
+        for index_name, (table_name, column_names) in indexes.items():
+            query = sql.SQL("CREATE INDEX {concurrently} IF NOT EXISTS {index} ON {table} ({columns})").format(
+                concurrently=sql.SQL("CONCURRENTLY" if concurrently else ""),
+                index=sql.Identifier(index_name),
                 table=sql.Identifier(table_name),
-                sec_id=sql.Literal(section_id)
+                columns=sql.SQL(', ').join(map(sql.Identifier, column_names))
             )
             try:
-                cursor.execute(child_delete_query)
-                print(f"All section_id '{section_id}' values deleted from table'{table_name}'")
+                cursor.execute(query)
+                print(f"Index {index_name} created on table {table_name}")
             except (Exception, psycopg2.Error) as error:
-                print(f"Error while deleting section_id '{section_id}' values from table '{table_name}':", error)
+                print(f"Error while creating index {index_name}:", error)
 
-        # delete id rows from 'sections' table
-        parent_delete_query = sql.SQL("DELETE FROM sections WHERE id = {sec_id};").format(
-            sec_id=sql.Literal(section_id),
-        )
+
+    @db.with_cursor
+    def drop_indexes(self, cursor, indexes=None, concurrently=False):
+        "Drop the secondary indexes in INDEXES, or in indexes, e.g. before a bulk load"
+        for index_name in (INDEXES if indexes is None else indexes):
+            query = sql.SQL("DROP INDEX {concurrently} IF EXISTS {index}").format(
+                concurrently=sql.SQL("CONCURRENTLY" if concurrently else ""),
+                index=sql.Identifier(index_name)
+            )
+            try:
+                cursor.execute(query)
+                print(f"Index {index_name} dropped")
+            except (Exception, psycopg2.Error) as error:
+                print(f"Error while dropping index {index_name}:", error)
+
+
+    @contextmanager
+    def without_indexes(self, indexes=None, load_indexes=None, concurrently=False):
+        """
+        Drop the secondary indexes, or those in indexes, for the duration of a block, and build
+        them again afterwards, so a bulk load doesn't update them row by row.  load_indexes are
+        smaller indexes the load needs in the meantime, which only exist during the block.
+        """
+        self.drop_indexes(indexes=indexes, concurrently=concurrently)
+        if load_indexes:
+            self.create_indexes(indexes=load_indexes, concurrently=concurrently)
         try:
-            cursor.execute(parent_delete_query)
-            print(f"All section_id '{section_id}' values deleted from table 'sections'")
-        except (Exception, psycopg2.Error) as error:
-            print(f"Error while deleting section_id '{section_id}' values from table 'sections':", error)
+            yield
+        finally:
+            self.create_indexes(indexes=indexes, concurrently=concurrently)
+            if load_indexes:
+                self.drop_indexes(indexes=load_indexes, concurrently=concurrently)
 
 
 if __name__ == "__main__":
@@ -213,6 +290,10 @@ if __name__ == "__main__":
     # columns
     # db_control.list_columns(table_name="sections")  # ok
 
+    # indexes
+    # db_control.create_indexes(concurrently=True)
+    # db_control.list_indexes()
+
     # values
     # db_control.list_table_values(table_name="phrases")  # ok
 
@@ -221,6 +302,9 @@ if __name__ == "__main__":
     # values
     # db_control.delete_all_values_one_table(table_name="phrases")  # ok
     # db_control.delete_all_values_by_section_id(section_id='grjd21-verse')  # ok
+    # db_control.delete_sections(['grjd21-verse', 'grjd21-chorus'])
+    # db_control.delete_tracks(['<spotify track id>'])
+    # db_control.add_cascading_foreign_keys()
     db_control.delete_all_values_all_tables()  # ok
     db_control.list_table_values(table_name="tracks")
 
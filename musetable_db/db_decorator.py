@@ -3,18 +3,46 @@ Class for connecting to a database or database cluster
 """
 
 import psycopg2
-from google.cloud import secretmanager
+from psycopg2 import pool
 from contextlib import contextmanager
 from functools import wraps
 import json
+import os
+import threading
+
+from musetable_db.const import PROJECT_ID, SECRET_ID, VERSION_ID, DB_MIN_CONNECTIONS, DB_MAX_CONNECTIONS
 
 class PostgresDB:
-    "PostgresDB class connects to a database by means of a decorator"
+    """
+    PostgresDB class connects to a database by means of a decorator.  Connections to the
+    database are kept in a thread-safe pool of min_connections to max_connections, so
+    decorated calls reuse them instead of connecting each time.  Modules share the one
+    instance, db, at the bottom of this file, so a process has a single pool.
+    """
 
-    def __init__(self, project_id: str, secret_id: str, version_id: int, db_port=5432):
+    def __init__(self, project_id: str, secret_id: str, version_id: int, db_port=5432,
+                 min_connections: int = DB_MIN_CONNECTIONS, max_connections: int = DB_MAX_CONNECTIONS):
         self.db_port = db_port
-        self.secret_details = self.get_secrets(project_id, secret_id, version_id)
+        self.secret_args = (project_id, secret_id, version_id)
+        self._secret_details = None  # fetched on first use, so importing this module doesn't call GCP
+        self.secrets_lock = threading.Lock()
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+
+        # the pool is created on first use, so importing a module that makes a PostgresDB doesn't connect
+        self.pool = None
+        self.pool_pid = None  # connections can't be shared with forked processes, which make their own pool
+        self.pool_lock = threading.Lock()
+        self.pool_slots = threading.BoundedSemaphore(max_connections)  # wait for a free connection instead of failing
+
 
+    @property
+    def secret_details(self) -> dict:
+        "Secret details for connecting to the database, fetched from Secret Manager once"
+        with self.secrets_lock:
+            if self._secret_details is None:
+                self._secret_details = self.get_secrets(*self.secret_args)
+        return self._secret_details
 
     def get_secrets(self, project_id: str, secret_id: str, version_id: int) -> dict:
         """
@@ -30,6 +58,8 @@ class PostgresDB:
         --------
         secret_details  : dictionary containing secret details
         """
+        from google.cloud import secretmanager
+
         # create secret manager client object
         client = secretmanager.SecretManagerServiceClient()
 
@@ -44,10 +74,9 @@ class PostgresDB:
 
         return secret_details
 
-    @contextmanager
-    def connection(self):
-        "Create connection to database in a context manager"
-        connection = psycopg2.connect(
+    def get_connection_details(self) -> dict:
+        "Keyword arguments of psycopg2.connect for the database"
+        return dict(
             # port=self.db_port,
             # **self.secret_details
             ### below is for testing ###
@@ -57,11 +86,69 @@ class PostgresDB:
             user='test_user',
             password='test_password',
         )
-        connection.autocommit = True
+
+
+    def get_pool(self) -> pool.ThreadedConnectionPool:
+        "Return the connection pool of this process, creating it on first use"
+        with self.pool_lock:
+            if self.pool is None or self.pool.closed or self.pool_pid != os.getpid():
+                self.pool = pool.ThreadedConnectionPool(
+                    self.min_connections,
+                    self.max_connections,
+                    **self.get_connection_details()
+                )
+                self.pool_pid = os.getpid()
+
+        return self.pool
+
+
+    def is_healthy(self, connection) -> bool:
+        "Check that a pooled connection still works before handing it out"
+        if connection.closed:
+            return False
         try:
-            yield connection
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            return True
+        except psycopg2.Error:
+            return False
+
+
+    def close_pool(self) -> None:
+        "Close every pooled connection, e.g. at the end of a bulk load"
+        with self.pool_lock:
+            if self.pool is not None and not self.pool.closed and self.pool_pid == os.getpid():
+                self.pool.closeall()
+            self.pool = None
+
+        return None
+
+
+    @contextmanager
+    def connection(self):
+        "Check out a pooled connection to the database in a context manager"
+        self.pool_slots.acquire()
+        try:
+            connection_pool = self.get_pool()
+            connection = connection_pool.getconn()
+            connection.autocommit = True
+
+            # replace a connection the server closed while it sat in the pool
+            if not self.is_healthy(connection):
+                connection_pool.putconn(connection, close=True)
+                connection = connection_pool.getconn()
+                connection.autocommit = True
+                if not self.is_healthy(connection):
+                    connection_pool.putconn(connection, close=True)
+                    raise psycopg2.OperationalError("could not get a healthy connection from the pool")
+
+            try:
+                yield connection
+            finally:
+                # the pool rolls back a transaction left open, and discards a broken connection
+                connection_pool.putconn(connection, close=bool(connection.closed))
         finally:
-            connection.close()
+            self.pool_slots.release()
 
     @contextmanager
     def cursor(self):
@@ -76,6 +163,23 @@ class PostgresDB:
                 cursor.close()
 
 
+    @contextmanager
+    def transaction(self):
+        """
+        Create cursor object in a context manager whose statements are committed together
+        when the block ends, or rolled back if it raises
+        """
+        with self.connection() as connection:
+            connection.autocommit = False
+            try:
+                with connection:  # commits on success, rolls back on an exception
+                    with connection.cursor() as cursor:
+                        yield cursor
+            finally:
+                if not connection.closed:
+                    connection.autocommit = True
+
+
     def with_cursor(self, func):
         "Decorator function for connecting to db"
         @wraps(func)
@@ -153,3 +257,6 @@ class PostgresDB:
     #         with self.cursor() as cursor:
     #             return func(cursor, self.connection, *args, **kwargs)
     #     return wrapper
+
+
+db = PostgresDB(PROJECT_ID, SECRET_ID, VERSION_ID)
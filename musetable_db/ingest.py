@@ -0,0 +1,138 @@
+"""
+Ingest many MusicXML files into the musetable database:
+
+    python -m musetable_db ingest data/*.mxl --workers 4
+
+Files are preprocessed in a pool of processes, and each one is loaded as soon as it's ready
+by a pool of threads sharing PostgresDB's connection pool, so parsing and loading overlap.
+Each file is loaded and verified in one transaction, parent tables (tracks, sections) before
+child tables (phrases, notes, harmony), and a file that fails is reported at the end
+without stopping the others.  For large loads, --drop-indexes drops the secondary indexes
+first and builds them again at the end, keeping a plain index on section_id, which the loads need.
+"""
+
+import argparse
+import contextlib
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from musetable_db.const import ROOT_DIR, INDEXES
+from musetable_db.db_control import DatabaseControl
+from musetable_db.db_decorator import db
+from musetable_db.insert import load_section, verify_section
+from musetable_db.preprocess import PreprocessXML
+
+# indexes dropped by --drop-indexes: all but the plain section_id ones.  load_section deletes a
+# section's rows and verify_section checksums them by section_id, so tables whose section_id index
+# is dropped, e.g. notes (section_id, offset_ql), get a plain one for the duration of the load
+BULK_LOAD_INDEXES = {
+    index_name: (table_name, column_names)
+    for index_name, (table_name, column_names) in INDEXES.items() if column_names != ['section_id']
+}
+LOAD_INDEXES = {
+    f"{table_name}_section_id_load_idx": (table_name, ['section_id'])
+    for table_name, column_names in BULK_LOAD_INDEXES.values() if column_names[0] == 'section_id'
+}
+
+
+def preprocess_file(mxl_filepath: str, playlist_filepath: str) -> tuple:
+    "Parse a file into the dictionaries of stream_to_dict.  Runs in a worker process"
+    return PreprocessXML(mxl_filepath, playlist_filepath).stream_to_dict()
+
+
+def load_file(data_dicts: tuple, table_names: list, tables_dict: dict) -> None:
+    """
+    Load one file's dictionaries and verify them in one transaction, so a file whose
+    checksums don't match is rolled back.  Raises ValueError for a mismatch.
+    """
+    with db.transaction() as cursor:
+        load_section(cursor, table_names, tables_dict, data_dicts)
+        mismatched_tables = verify_section(cursor, table_names, tables_dict, data_dicts)
+        if mismatched_tables:
+            raise ValueError(f"checksums don't match in tables {', '.join(mismatched_tables)}")
+
+    return None
+
+
+def ingest(mxl_filepaths: list, playlist_filepath: str, n_workers: int = 4) -> dict:
+    """
+    Preprocess and load MusicXML files in parallel.
+
+    Parameters:
+    -----------
+    mxl_filepaths       : paths to MusicXML files
+    playlist_filepath   : path to the playlist csv with track data from the Spotify API
+    n_workers           : number of preprocessing processes, and of loading threads (at
+                          most the size of the connection pool)
+
+    Returns:
+    --------
+    failures    : dictionary of filepath: error message for every file that failed
+    """
+    failures = {}
+    n_loaded = 0
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=n_workers) as preprocess_pool, \
+            ThreadPoolExecutor(max_workers=min(n_workers, db.max_connections)) as load_pool:
+
+        # start preprocessing before connecting, so worker processes don't inherit connections
+        preprocess_futures = {
+            preprocess_pool.submit(preprocess_file, mxl_filepath, playlist_filepath): mxl_filepath
+            for mxl_filepath in mxl_filepaths
+        }
+        table_names, tables_dict = PreprocessXML(mxl_filepaths[0], playlist_filepath).make_tables_dict()
+
+        # load each file as soon as it's preprocessed
+        load_futures = {}
+        for future in as_completed(preprocess_futures):
+            mxl_filepath = preprocess_futures[future]
+            try:
+                data_dicts = future.result()
+            except Exception as error:
+                failures[mxl_filepath] = f"preprocessing failed: {type(error).__name__}: {error}"
+                print(f"- error preprocessing {mxl_filepath}")
+                continue
+            load_futures[load_pool.submit(load_file, data_dicts, table_names, tables_dict)] = mxl_filepath
+
+        for future in as_completed(load_futures):
+            mxl_filepath = load_futures[future]
+            try:
+                future.result()
+            except Exception as error:
+                failures[mxl_filepath] = f"loading failed: {type(error).__name__}: {error}"
+                print(f"- error loading {mxl_filepath}")
+                continue
+            n_loaded += 1
+            print(f"- loaded {mxl_filepath}")
+
+    db.close_pool()
+    print(f"{n_loaded} of {len(mxl_filepaths)} files ingested in {time.perf_counter() - start:.1f} seconds")
+    if failures:
+        print(f"{len(failures)} files failed:")
+        for mxl_filepath, message in failures.items():
+            print(f"- {mxl_filepath}: {message}")
+
+    return failures
+
+
+def main(argv: list = None) -> int:
+    "Command line interface of musetable_db.  Returns the exit code"
+    parser = argparse.ArgumentParser(prog="python -m musetable_db", description="Manage the musetable database")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    ingest_parser = subparsers.add_parser("ingest", help="preprocess MusicXML files and load them into the database")
+    ingest_parser.add_argument("mxl_filepaths", nargs="+", help="MusicXML files, e.g. data/*.mxl")
+    ingest_parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="number of parallel workers")
+    ingest_parser.add_argument("--playlist", default=os.path.join(ROOT_DIR, "data", "playlist.csv"), help="playlist csv with Spotify track data")
+    ingest_parser.add_argument("--drop-indexes", action="store_true", help="drop secondary indexes other than plain section_id ones during the load, and rebuild them after")
+
+    args = parser.parse_args(argv)
+    if args.command == "ingest":
+        indexes = DatabaseControl().without_indexes(BULK_LOAD_INDEXES, LOAD_INDEXES) if args.drop_indexes else contextlib.nullcontext()
+        with indexes:
+            failures = ingest(args.mxl_filepaths, args.playlist, max(1, args.workers))
+        return 1 if failures else 0
+
+    return 0
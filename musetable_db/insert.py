@@ -1,14 +1,238 @@
 """
 Insert data into database
+
+Each file is loaded in one transaction: its track and section are upserted, and the rows of
+the section in the child tables are replaced.  Child tables are loaded with COPY ... FROM
+STDIN from an in-memory CSV buffer, written straight from the columns made by
+PreprocessXML.stream_to_dict.  The child tables have no unique constraints and the rows of
+the section are deleted first, so COPY needs no fallback for conflicting rows.
 """
-import psycopg2
+import csv
+import hashlib
+import io
+import math
+from fractions import Fraction
 from psycopg2 import sql, extras
-from musetable_db.db_decorator import PostgresDB
+from musetable_db.db_decorator import db
 from musetable_db.preprocess import PreprocessXML
 
-from musetable_db.const import PROJECT_ID, SECRET_ID, VERSION_ID
+from musetable_db.const import TABLE_KEYS
+
+
+COPY_NULL = r'\N'  # so empty strings aren't read as NULL
+INSERT_PAGE_SIZE = 1000  # rows per INSERT statement
+
+# row count and order-independent checksum of a table's rows for one id: the sum of the first
+# 64 bits of the md5 of each row's text, which checksum_columns reproduces client-side
+CHECKSUM_SQL = """
+SELECT {table_name}, count(*), coalesce(sum(('x' || left(md5(t::text), 16))::bit(64)::bigint), 0)
+FROM {table} t WHERE {column} = %s
+"""
+# Postgres 12 made float8 output the shortest exact digits, which format_float_text reproduces
+MIN_SERVER_VERSION = 120000
+
+
+def get_table_columns(data_dict: dict, column_names: list) -> list:
+    """
+    Return the columns of a dictionary from stream_to_dict in the table's column order.
+    The tracks and sections dictionaries hold one row of values rather than columns.
+    """
+    columns = [data_dict[col] for col in column_names]
+    if not isinstance(columns[0], list):
+        columns = [[value] for value in columns]
+
+    return columns
+
+
+def format_copy_value(value):
+    "Format a value for a COPY CSV buffer"
+    if value is None:
+        return COPY_NULL
+    if isinstance(value, Fraction):  # music21 durations of tuplets
+        return float(value)
+    return value
+
+
+def make_copy_buffer(columns: list) -> io.StringIO:
+    "Write columns as the rows of an in-memory CSV buffer, ready for COPY ... FROM STDIN"
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    for row in zip(*columns):
+        writer.writerow([format_copy_value(value) for value in row])
+    buffer.seek(0)
+
+    return buffer
+
+
+def copy_table(cursor, table_name: str, column_names: list, columns: list) -> None:
+    "Load columns into a table with COPY ... FROM STDIN"
+    query = sql.SQL("COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv, NULL {null})").format(
+        table=sql.Identifier(table_name),
+        columns=sql.SQL(', ').join(map(sql.Identifier, column_names)),
+        null=sql.Literal(COPY_NULL)
+    )
+    cursor.copy_expert(query, make_copy_buffer(columns))
+
+    return None
+
+
+def insert_table(cursor, table_name: str, column_names: list, columns: list, key_columns: list = None) -> None:
+    """
+    Insert columns into a table in pages of INSERT_PAGE_SIZE rows.  Rows whose key_columns
+    are already in the table are updated, or skipped if key_columns is None.
+    """
+    if key_columns is None:
+        on_conflict = sql.SQL("ON CONFLICT DO NOTHING")
+    else:
+        on_conflict = sql.SQL("ON CONFLICT ({keys}) DO UPDATE SET {updates}").format(
+            keys=sql.SQL(', ').join(map(sql.Identifier, key_columns)),
+            updates=sql.SQL(', ').join(
+                sql.SQL("{column} = EXCLUDED.{column}").format(column=sql.Identifier(col))
+                for col in column_names if col not in key_columns
+            )
+        )
+    query = sql.SQL("INSERT INTO {table} ({columns}) VALUES %s {on_conflict}").format(
+        table=sql.Identifier(table_name),
+        columns=sql.SQL(', ').join(map(sql.Identifier, column_names)),
+        on_conflict=on_conflict
+    )
+    extras.execute_values(cursor, query, list(zip(*columns)), page_size=INSERT_PAGE_SIZE)
+
+    return None
+
+
+def load_section(cursor, table_names: list, tables_dict: dict, data_dicts: tuple) -> None:
+    """
+    Load the dictionaries made by PreprocessXML.stream_to_dict for one section, in the
+    transaction of cursor.  The track and section are upserted on their ids, and the rows
+    of the section in the child tables are deleted and loaded again, so loading a file a
+    second time leaves the same rows rather than duplicates.
+
+    Parameters:
+    -----------
+    cursor      : cursor of a connection in a transaction (see PostgresDB.transaction)
+    table_names : table names in the order of data_dicts, from make_tables_dict
+    tables_dict : column names of each table, from make_tables_dict
+    data_dicts  : dictionaries returned by stream_to_dict
+    """
+    section_id = data_dicts[1]['id']
+
+    # loads of the same section by other workers wait until this transaction ends
+    cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s));", (section_id,))
+
+    for table_name, data_dict in zip(table_names, data_dicts):
+        column_names = tables_dict[table_name]
+        columns = get_table_columns(data_dict, column_names)
+
+        if table_name in TABLE_KEYS:
+            insert_table(cursor, table_name, column_names, columns, TABLE_KEYS[table_name])
+            continue
+
+        if 'section_id' in column_names:
+            delete_query = sql.SQL("DELETE FROM {table} WHERE section_id = %s;").format(
+                table=sql.Identifier(table_name)
+            )
+            cursor.execute(delete_query, (section_id,))
+
+        if columns[0]:
+            copy_table(cursor, table_name, column_names, columns)
+
+    return None
+
+
+def format_float_text(value: float) -> str:
+    "Format a float the way Postgres's float8 output does"
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return 'Infinity' if value > 0 else '-Infinity'
+
+    # both use the shortest exact digits, but float8 switches to an exponent at 1e15 and repr at 1e16
+    text = repr(value)
+    if 1e15 <= abs(value) < 1e16:
+        digits = text.lstrip('-').replace('.', '').rstrip('0')
+        text = format(value, f'.{len(digits) - 1}e')
+    elif text.endswith('.0'):
+        text = text[:-2]
+
+    return text
+
+
+def format_field_text(value) -> str:
+    "Format a value the way Postgres formats a field of row::text"
+    if value is None:
+        return ''
+    if isinstance(value, (float, Fraction)):
+        text = format_float_text(float(value))
+    else:
+        text = str(value)
+
+    # fields are quoted if they're empty or have delimiters or whitespace, doubling quotes and backslashes
+    if text == '' or any(char in '"\\(),' or char.isspace() for char in text):
+        text = '"' + text.replace('\\', '\\\\').replace('"', '""') + '"'
+
+    return text
+
+
+def hash_row_text(row_text: str) -> int:
+    "Signed 64-bit integer from the first 16 hex digits of the md5 of a row's text, as in CHECKSUM_SQL"
+    return int.from_bytes(hashlib.md5(row_text.encode('utf-8')).digest()[:8], 'big', signed=True)
+
+
+def checksum_columns(columns: list) -> tuple:
+    "Return (row count, order-independent checksum) of the rows in columns, computed like CHECKSUM_SQL"
+    rows = list(zip(*columns))
+    checksum = sum(hash_row_text('(' + ','.join(format_field_text(value) for value in row) + ')') for row in rows)
+
+    return (len(rows), checksum)
+
+
+def verify_section(cursor, table_names: list, tables_dict: dict, data_dicts: tuple) -> list:
+    """
+    Compare the row count and checksum of each table's rows for a section in the database
+    with the same figures computed from data_dicts, in one query, without fetching the rows.
+    Must run in a transaction (see PostgresDB.transaction), where float output is set to
+    match format_float_text.
+
+    Returns:
+    --------
+    mismatched_tables (list): names of the tables whose counts or checksums differ
+    """
+    if cursor.connection.server_version < MIN_SERVER_VERSION:
+        raise RuntimeError(f"checksums need Postgres 12 or later, the server is {cursor.connection.server_version}")
+    # shortest exact float digits, whatever extra_float_digits the server or role sets
+    cursor.execute("SET LOCAL extra_float_digits = 1;")
+
+    track_id = data_dicts[0]['id']
+    section_id = data_dicts[1]['id']
+
+    # one SELECT per table, in one round trip
+    queries = []
+    params = []
+    for table_name in table_names[:len(data_dicts)]:
+        if table_name == 'tracks':
+            id_col, id_val = ('id', track_id)
+        elif table_name == 'sections':
+            id_col, id_val = ('id', section_id)
+        else:
+            id_col, id_val = ('section_id', section_id)
+        queries.append(sql.SQL(CHECKSUM_SQL).format(
+            table_name=sql.Literal(table_name),
+            table=sql.Identifier(table_name),
+            column=sql.Identifier(id_col)
+        ))
+        params.append(id_val)
+    cursor.execute(sql.SQL(" UNION ALL ").join(queries), params)
+    db_checksums = {table_name: (count, int(checksum)) for table_name, count, checksum in cursor.fetchall()}
+
+    mismatched_tables = []
+    for table_name, data_dict in zip(table_names, data_dicts):
+        columns = get_table_columns(data_dict, tables_dict[table_name])
+        if checksum_columns(columns) != db_checksums[table_name]:
+            mismatched_tables.append(table_name)
+
+    return mismatched_tables
 
-db = PostgresDB(PROJECT_ID, SECRET_ID, VERSION_ID)
 
 class InsertValues:
     """
@@ -18,39 +242,33 @@ class InsertValues:
 
     def __init__(self, mxl_filepath, playlist_filepath):
         self.preproc = PreprocessXML(mxl_filepath, playlist_filepath)
-        # self.data_dicts = self.preproc.stream_to_dict()
         self.preprocessed_data = self.preproc.preprocess_data()
-        self.table_names, self._ = self.preproc.make_tables_dict()
+        self.data_dicts = self.preproc.data_dicts
+        self.table_names, self.tables_dict = self.preproc.make_tables_dict()
 
 
     def insert_data(self):
-
-        # iterate through each table and insert data
+        "Load the file in one transaction, so it's committed or rolled back as a whole"
         print("inserting data into database ... ")
-        with db.connection() as connection:
-            with connection.cursor() as cursor:
-                for table_name, data in zip(self.table_names, self.preprocessed_data):
+        with db.transaction() as cursor:
+            load_section(cursor, self.table_names, self.tables_dict, self.data_dicts)
+        print("data insertion complete")
 
-                    query = sql.SQL("INSERT INTO {table} VALUES ({values});").format(
-                        table=sql.Identifier(table_name),
-                        values=sql.SQL(', ').join(sql.Placeholder() * len(data[0]))
-                    )
-                    # print(query.as_string(connection))  # check how query looks as a string
 
+    def verify_data_insert(self) -> list:
+        "Check the inserted rows by row counts and checksums.  Returns the names of tables that don't match"
+        print("verifying data insertion ... ")
+        with db.transaction() as cursor:
+            mismatched_tables = verify_section(cursor, self.table_names, self.tables_dict, self.data_dicts)
+        for table_name in mismatched_tables:
+            print(f"checksum mismatch in table {table_name}")
 
-                    # avoid inserting duplicate track data
-                    try:
-                        extras.execute_batch(cursor, query, data)
-                        print(f"- inserted data into table {table_name}")
-                    except psycopg2.errors.UniqueViolation:
-                        # rollback the current transaction and continue with loop
-                        connection.rollback()
-                        continue
-                print("data insertion complete")
+        return mismatched_tables
 
 
     @ db.with_cursor
     def validate_data_insert(self, cursor):
+        "Compare every inserted row with the preprocessed data"
 
         print("validating data insertion ... ")
         # store track_id and section_id as variables
@@ -106,8 +324,11 @@ class InsertValues:
         # insert data into database
         self.insert_data()
 
-        # validate that the data was inserted correctly
-        self.validate_data_insert()
+        # verify that the data was inserted correctly, comparing every row only if the checksums differ
+        if self.verify_data_insert():
+            return self.validate_data_insert()
+
+        print("Data successfully added to database!")
 
 if __name__ == "__main__":
 
@@ -125,12 +346,7 @@ if __name__ == "__main__":
     inserter.file_to_sql()
 
     ### insert all .mxl files ###
-    # import glob
-    # mxl_files = glob.glob(os.path.join("data", "*.mxl"))
-    # playlist_filepath = os.path.join(ROOT_DIR, 'data', 'playlist.csv')
-    # for mxl_filepath in mxl_files:
-    #     inserter = InsertValues(mxl_filepath, playlist_filepath)
-    #     inserter.file_to_sql()
+    # python -m musetable_db ingest data/*.mxl --workers 4  (see ingest.py)
 
 
     ### checking different functions ###
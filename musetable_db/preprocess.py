@@ -7,13 +7,51 @@ be inserted into the database using the insert.py module
 import os
 import music21 as m21
 import pandas as pd
-import psycopg2
-from psycopg2 import sql
-from musetable_db.db_decorator import PostgresDB
+from musetable_db.db_decorator import db
 
-from musetable_db.const import PROJECT_ID, SECRET_ID, VERSION_ID
+from musetable_db.const import TABLE_NAMES
+
+
+# table name: column names, read from the catalog on first use
+tables_cache = {}
+
+
+@db.with_cursor
+def fetch_tables_dict(cursor) -> dict:
+    """
+    Read the columns of every table in the database from information_schema, in column
+    order.  Unlike SELECT * on each table, this doesn't get slower as the tables grow.
+    """
+    query = """
+    SELECT c.table_name, c.column_name
+    FROM information_schema.columns c
+    INNER JOIN information_schema.tables t
+        ON t.table_schema = c.table_schema AND t.table_name = c.table_name
+    WHERE c.table_schema = 'public'
+        AND t.table_type = 'BASE TABLE'
+    ORDER BY c.table_name, c.ordinal_position;
+    """
+    cursor.execute(query)
+
+    tables_dict = {}
+    for table_name, column_name in cursor.fetchall():
+        tables_dict.setdefault(table_name, []).append(column_name)
+
+    return tables_dict
+
+
+def clear_tables_cache() -> None:
+    "Forget the cached table columns, so the next make_tables_dict reads them again"
+    tables_cache.clear()
+    return None
+
+
+def get_table_position(table_name: str) -> int:
+    "Sort key putting tables in the order of stream_to_dict, with parent tables first"
+    if table_name in TABLE_NAMES:
+        return TABLE_NAMES.index(table_name)
+    return len(TABLE_NAMES)
 
-db = PostgresDB(PROJECT_ID, SECRET_ID, VERSION_ID)
 
 class PreprocessXML:
     """PreprocessXML prepares a MusicXML file to be inserted into a database"""
@@ -381,33 +419,23 @@ class PreprocessXML:
 
         return data_dicts
 
-    @db.with_cursor
-    def make_tables_dict(self, cursor) -> tuple:
+    def make_tables_dict(self) -> tuple:
         """
         Create dictionary of all tables and their columns in a database.  Important
-        for ensuring the correct order of column names when inserting data.
+        for ensuring the correct order of column names when inserting data.  The result is
+        read from the catalog once per process; call clear_tables_cache() after changing
+        the schema.
 
         Returns:
         --------
-        table_names (list): all table names in the database
+        table_names (list): all table names in the database, in the order of stream_to_dict
         tables_dict (dict): keys are table names, values are lists of column names
         """
+        if not tables_cache:
+            tables_cache.update(fetch_tables_dict())
 
-        tables_dict = {}
-
-        # retrieve table names from database and store in 'tables' list
-        query = "SELECT table_name FROM information_schema.tables WHERE table_schema = 'public';"
-        cursor.execute(query)
-        table_names = [table[0] for table in cursor.fetchall()]
-
-        # retrieve column names from each table in the database
-        for table_name in table_names:
-            query = sql.SQL("SELECT * FROM {table};").format(
-                table=sql.Identifier(table_name)
-            )
-            cursor.execute(query)
-            column_names = [desc[0] for desc in cursor.description]
-            tables_dict[table_name] = column_names
+        table_names = sorted(tables_cache, key=get_table_position)
+        tables_dict = {table_name: list(tables_cache[table_name]) for table_name in table_names}
 
         return (table_names, tables_dict)
 
@@ -432,6 +460,7 @@ class PreprocessXML:
         # prepare data variables for preprocessing
         table_names, tables_dict = self.make_tables_dict()
         data_dicts = self.stream_to_dict()
+        self.data_dicts = data_dicts  # kept in columns for COPY loads (see insert.py)
 
         print("preprocessing data ... ")
         for table_name, data_dict in zip(table_names, data_dicts):
@@ -0,0 +1,443 @@
+import os
+import sys
+
+import pytest
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'musetable', 'api'))  # api modules use flat imports
+
+from preprocess import PreprocessXML
+from melody_index import MelodyIndex
+from chord_index import ChordIndex
+from phrase_embedding import PhraseEmbedding
+from transitions import ChordTransitions
+from serialize import ARROW_STREAM_MEDIA_TYPE, read_arrow_ipc
+from fastapi.testclient import TestClient
+from api import app
+
+mxl_filepath = os.path.join(ROOT_DIR, 'data', 'pasta piece.mxl')
+
+@pytest.fixture(scope="module")
+def preproc():
+    preproc = PreprocessXML()
+    preproc.load_data(mxl_filepath)
+    preproc.input_all()
+    return preproc
+
+@pytest.fixture(scope="module")
+def data_dict(preproc):
+    return preproc.data_dict
+
+def test_melody_index(data_dict, tmp_path):
+    melody_index = MelodyIndex(max_n=3)
+    melody_index.add_track(data_dict)
+
+    # every phrase's full interval sequence should be found, including patterns longer than max_n
+    for mp_id, phrase in melody_index.phrases.items():
+        hits = melody_index.search(phrase['tokens'])
+        assert (phrase['track_id'], phrase['sec_id'], mp_id, phrase['ids'][0]) in hits
+
+    # rhythm and pitch filters only narrow the results
+    mp_id, phrase = next(iter(melody_index.phrases.items()))
+    intervals = phrase['tokens'][:2]
+    all_hits = melody_index.search(intervals)
+    rhythm_hits = melody_index.search(intervals, durations=phrase['durations'][:3], pitch_class=phrase['pitch_classes'][0])
+    assert set(rhythm_hits) <= set(all_hits)
+    assert rhythm_hits[0][3] in phrase['ids']
+
+    # saving, loading, and re-adding a track doesn't change the index
+    filepath = os.path.join(tmp_path, 'melody.idx')
+    melody_index.save(filepath)
+    loaded = MelodyIndex.load(filepath)
+    loaded.add_track(data_dict)
+    assert loaded.index == melody_index.index
+
+    # removing the only track empties the index
+    loaded.remove_track(data_dict['tracks']['track_id'][0])
+    assert loaded.index == {} and loaded.phrases == {}
+
+def test_chord_index(data_dict):
+    chord_index = ChordIndex()
+    chord_index.add_track(data_dict)
+
+    # the first and third harmonic phrases of pasta piece have the same progression
+    hp_ids = list(chord_index.phrases.keys())
+    assert hp_ids[2] in [hit[2] for hit in chord_index.search_like(hp_ids[0])]
+
+    # exact chord kinds and start kinds only narrow the results
+    progression = chord_index.phrases[hp_ids[4]]['tokens'][:2]
+    hits = chord_index.search(progression)
+    assert hp_ids[4] in [hit[2] for hit in hits]
+    assert set(chord_index.search([(3, 'major'), (-3, 'major')], start_kind='major')) <= set(hits)
+    assert chord_index.search(progression, start_kind='diminished-seventh') == []
+
+def test_phrase_embedding(data_dict, tmp_path):
+    embedding = PhraseEmbedding()
+    embedding.add_track(data_dict)
+    assert embedding.matrix.shape[0] == len(data_dict['melodic_phrases']['mp_id'])
+
+    # brute force neighbours are sorted, and never include the query phrase
+    mp_id = embedding.mp_ids[0]
+    neighbours = embedding.similar_to(mp_id, k=3)[0]
+    similarities = [sim for _, sim in neighbours]
+    assert len(neighbours) == 3 and mp_id not in [n_id for n_id, _ in neighbours]
+    assert similarities == sorted(similarities, reverse=True)
+
+    # a phrase is its own nearest neighbour, with or without LSH
+    assert embedding.knn(embedding.matrix[0], k=1)[0][0][0] == mp_id
+    assert embedding.knn(embedding.matrix[0], k=1, use_lsh=True)[0][0][0] == mp_id
+
+    # saving and loading keeps the matrix and ids
+    filepath = os.path.join(tmp_path, 'embedding.npz')
+    embedding.save(filepath)
+    loaded = PhraseEmbedding.load(filepath)
+    assert loaded.mp_ids == embedding.mp_ids
+    assert (loaded.matrix == embedding.matrix).all()
+
+def test_chord_transitions(data_dict, tmp_path):
+    transitions = ChordTransitions()
+    transitions.add_track(data_dict)
+    track_id = data_dict['tracks']['track_id'][0]
+    track_root, track_kind = transitions.tracks[track_id]
+
+    # one kind transition between each pair of chords, and sections never count more than the track
+    assert track_kind.sum() == len(data_dict['chords']['chord_id']) - 1
+    assert sum(transitions.sections[sec_id][1].sum() for sec_id in data_dict['sections']['sec_id']) <= track_kind.sum()
+    assert (transitions.corpus_root == track_root).all()
+    assert transitions.root_movement_counts(track_root).sum() == track_root.sum()
+
+    probs = transitions.transition_probabilities(transitions.corpus_kind)
+    assert all(row_sum == 0 or abs(row_sum - 1) < 1e-9 for row_sum in probs.sum(axis=1))
+
+    # saving and loading keeps all matrices
+    filepath = os.path.join(tmp_path, 'transitions.npz')
+    transitions.save(filepath)
+    loaded = ChordTransitions.load(filepath)
+    assert loaded.track_sections == transitions.track_sections
+    assert (loaded.sections[data_dict['sections']['sec_id'][1]][0] == transitions.sections[data_dict['sections']['sec_id'][1]][0]).all()
+
+    # subtracting the only track empties the corpus counts
+    loaded.remove_track(track_id)
+    assert loaded.corpus_root.sum() == 0 and loaded.corpus_kind.sum() == 0
+
+def test_arrow_export(preproc, tmp_path):
+    arrow_tables = preproc.to_arrow()
+    assert list(arrow_tables.keys()) == list(preproc.data_dict.keys())
+
+    notes = arrow_tables['notes']
+    assert notes.num_rows == len(preproc.data_dict['notes']['note_id'])
+    assert notes.column_names == list(preproc.data_dict['notes'].keys())
+    assert str(notes.schema.field('note_id').type).startswith('dictionary')
+    assert notes.schema.field('mp_id').nullable and not notes.schema.field('midi_num').nullable
+    assert notes.column('duration').to_pylist() == preproc.data_dict['notes']['duration']
+
+    # one parquet file per table
+    filepaths = preproc.write_parquet(tmp_path)
+    assert len(filepaths) == len(arrow_tables)
+    assert all(os.path.exists(filepath) for filepath in filepaths)
+
+def test_api_arrow_response():
+    client = TestClient(app)
+    response = client.post("/preprocess", params={"mxl_filepath": mxl_filepath}, headers={"Accept": ARROW_STREAM_MEDIA_TYPE})
+    assert response.headers["content-type"] == ARROW_STREAM_MEDIA_TYPE
+
+    json_response = client.post("/preprocess", params={"mxl_filepath": mxl_filepath}).json()
+    arrow_tables = read_arrow_ipc(response.content)
+    assert list(arrow_tables.keys()) == list(json_response.keys())
+    assert arrow_tables['notes'].column('note_id').to_pylist() == json_response['notes']['note_id']
+
+def test_api_json_response():
+    client = TestClient(app)
+    response = client.post("/preprocess", params={"mxl_filepath": mxl_filepath}, headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.json()["tracks"]["track_name"] == ["Pasta Piece"]
+
+    # project tables and columns
+    params = {"mxl_filepath": mxl_filepath, "tables": ["tracks", "notes"], "columns": ["notes.note_id", "notes.midi_num"]}
+    projected = client.post("/preprocess", params=params).json()
+    assert list(projected.keys()) == ["tracks", "notes"]
+    assert list(projected["notes"].keys()) == ["note_id", "midi_num"]
+
+    # unknown names are rejected before the cache lookup, so the file isn't processed for them
+    import api
+    n_misses = api.cache.stats['misses']
+    params["columns"] = ["notes.not_a_column"]
+    assert client.post("/preprocess", params=params).status_code == 400
+    assert api.cache.stats['misses'] == n_misses
+
+def test_api_upload(monkeypatch):
+    import upload
+    client = TestClient(app)
+    with open(mxl_filepath, 'rb') as file:
+        mxl_bytes = file.read()
+    expected = client.post("/preprocess", params={"mxl_filepath": mxl_filepath}).json()
+
+    # raw body and multipart uploads give the same result as reading from the filesystem
+    assert client.post("/preprocess/upload", content=mxl_bytes).json() == expected
+    assert client.post("/preprocess/upload", files={"file": ("pasta piece.mxl", mxl_bytes)}).json() == expected
+
+    assert client.post("/preprocess/upload", content=b"not a score").status_code == 400
+    monkeypatch.setattr(upload, "MAX_UPLOAD_BYTES", 100)
+    assert client.post("/preprocess/upload", content=mxl_bytes).status_code == 413
+
+def test_extract_musicxml():
+    import io
+    import zipfile
+    with open(mxl_filepath, 'rb') as file:
+        mxl_bytes = file.read()
+    preproc = PreprocessXML()
+    assert '<score-partwise' in preproc.extract_musicxml(mxl_bytes)
+
+    # a small archive that decompresses past the limit is rejected before it's read whole
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('score.xml', b'<score-partwise>' + b' ' * 10000)
+    with zipfile.ZipFile(io.BytesIO(buffer.getvalue())) as archive:
+        with pytest.raises(ValueError):
+            preproc.read_archive_member(archive, 'score.xml', max_bytes=1000)
+        assert len(preproc.read_archive_member(archive, 'score.xml', max_bytes=20000)) == 10016
+
+    # so is a corrupted deflate stream
+    corrupted = bytearray(buffer.getvalue())
+    corrupted[40:60] = b'\xff' * 20
+    with pytest.raises(ValueError):
+        preproc.extract_musicxml(bytes(corrupted))
+
+def test_worker_pool(caplog):
+    import asyncio
+    import time
+    from workers import WorkerPool
+
+    async def run_jobs(pool):
+        await pool.warm_up()
+        # the second job waits for the only worker, and the wait doesn't count towards its timeout
+        await asyncio.gather(pool.run(time.sleep, 0.6, timeout=1.0), pool.run(time.sleep, 0.6, timeout=1.0))
+
+        # a job that times out takes its worker with it, and the next job gets a fresh one
+        processes = list(pool.executor._processes.values())
+        with pytest.raises(asyncio.TimeoutError):
+            await pool.run(time.sleep, 60, timeout=0.1)
+        assert pool.executor is None and pool.retired == []
+        processes[0].join(5)
+        assert not processes[0].is_alive()
+        assert await pool.run(abs, -1) == 1
+
+    pool = WorkerPool(max_workers=1)
+    asyncio.run(run_jobs(pool))
+    assert pool.n_pending == 0
+    pool.shutdown()
+
+    # with the lifespan running, requests are served by the app's own pool, warmed up on startup
+    caplog.set_level("INFO", logger="api")
+    with TestClient(app) as client:
+        assert "workers warmed up in" in caplog.text
+        assert client.get("/").status_code == 200
+        workers = client.get("/health").json()["startup"]["workers"]
+        assert len(workers) >= 1 and all(worker["validation_message"] == "all values validated!" for worker in workers)
+        assert client.post("/preprocess", params={"mxl_filepath": mxl_filepath}).status_code == 200
+
+def test_result_cache(tmp_path):
+    import api
+    from cache import ResultCache, make_cache_key
+
+    # same bytes and options give the same key, whatever the order of tables
+    assert make_cache_key(b"x", False, ["notes", "tracks"]) == make_cache_key(b"x", False, ["tracks", "notes"])
+    assert make_cache_key(b"x", False) != make_cache_key(b"x", True)
+
+    # the disk tier is shared by separate instances
+    db_path = str(tmp_path / "cache.sqlite")
+    ResultCache(max_items=1, db_path=db_path).set("key", {"a": 1})
+    disk_cache = ResultCache(max_items=1, db_path=db_path)
+    assert disk_cache.get("key") == {"a": 1} and disk_cache.get("key") == {"a": 1}
+    assert disk_cache.get_stats()["disk_hits"] == 1 and disk_cache.get_stats()["memory_hits"] == 1
+
+    # the disk tier keeps the newest values, and is read and written in a thread from async code
+    import asyncio
+    from cache import SQLiteCache
+    small_cache = ResultCache(max_items=0, db_path=str(tmp_path / "small.sqlite"))
+    small_cache.disk = SQLiteCache(small_cache.disk.db_path, max_items=2)
+    for key in ["a", "b", "c"]:
+        asyncio.run(small_cache.set_async(key, key))
+    assert len(small_cache.disk) == 2 and small_cache.disk.get("a") is None
+    assert asyncio.run(small_cache.get_async("c")) == "c"
+
+    client = TestClient(app)
+    api.cache.clear()
+    first = client.post("/preprocess", params={"mxl_filepath": mxl_filepath})
+    second = client.post("/preprocess", params={"mxl_filepath": mxl_filepath}, headers={"If-None-Match": first.headers["etag"]})
+    assert second.status_code == 304
+    assert client.get("/cache").json()["memory_hits"] >= 1
+
+    # other representations have other ETags
+    gzipped = client.post("/preprocess", params={"mxl_filepath": mxl_filepath}, headers={"Accept-Encoding": "gzip"})
+    assert gzipped.headers["etag"] != first.headers["etag"]
+
+def test_api_batch():
+    import json
+    client = TestClient(app)
+    with open(mxl_filepath, 'rb') as file:
+        mxl_bytes = file.read()
+    expected = client.post("/preprocess", params={"mxl_filepath": mxl_filepath}).json()
+
+    files = [("files", ("pasta piece.mxl", mxl_bytes)), ("files", ("broken.mxl", b"not a score"))]
+    params = {"mxl_filepaths": [mxl_filepath, "missing.mxl"]}
+    response = client.post("/preprocess/batch", params=params, files=files)
+    records = sorted([json.loads(line) for line in response.text.splitlines()], key=lambda record: record["index"])
+
+    # one line per file, and failures don't affect the other files
+    assert [record["status"] for record in records] == ["ok", "error", "ok", "error"]
+    assert records[0]["data"] == expected and records[2]["data"] == expected
+    assert records[1]["status_code"] == 400 and records[3]["status_code"] == 400
+
+    assert client.post("/preprocess/batch").status_code == 400
+
+def test_api_jobs(tmp_path):
+    import time
+    from jobs import SQLiteJobStore, make_job
+
+    # a queued job is claimed once
+    store = SQLiteJobStore(str(tmp_path / "jobs.sqlite"))
+    job = make_job("a.mxl", {"comprehensive": False})
+    store.enqueue(job, b"score")
+    claimed, mxl_bytes = store.claim()
+    assert claimed["job_id"] == job["job_id"] and claimed["status"] == "running" and mxl_bytes == b"score"
+    assert store.claim() is None and store.count("running") == 1
+
+    # a running job whose consumer stopped renewing its lease is queued and claimed again
+    store.lease = 0.1
+    store.heartbeat(job["job_id"])
+    assert store.claim() is None
+    time.sleep(0.2)
+    reclaimed, mxl_bytes = store.claim()
+    assert reclaimed["job_id"] == job["job_id"] and mxl_bytes == b"score"
+
+    # a job running when the server shuts down is queued again, not failed
+    import asyncio
+    from jobs import JobManager
+
+    store = SQLiteJobStore(str(tmp_path / "stopped_jobs.sqlite"))
+
+    async def run_until_stopped():
+        manager = JobManager(store, lambda job, mxl_bytes: asyncio.sleep(10))
+        manager.start()
+        queued = await manager.submit(b"score", "b.mxl", {"comprehensive": False})
+        while store.get(queued["job_id"])["status"] != "running":
+            await asyncio.sleep(0.01)
+        await manager.stop()
+        return queued["job_id"]
+
+    stopped_id = asyncio.run(run_until_stopped())
+    assert store.get(stopped_id)["status"] == "queued"
+    assert store.claim()[0]["job_id"] == stopped_id
+
+    with TestClient(app) as client:
+        expected = client.post("/preprocess", params={"mxl_filepath": mxl_filepath}).json()
+        response = client.post("/jobs", params={"mxl_filepath": mxl_filepath})
+        assert response.status_code == 202
+        failed_id = client.post("/jobs", content=b"not a score").json()["job_id"]
+        assert client.post("/jobs", params={"mxl_filepath": mxl_filepath, "tables": ["not_a_table"]}).status_code == 400
+
+        job_id = response.json()["job_id"]
+        for _ in range(100):
+            if client.get(f"/jobs/{failed_id}").json()["status"] == "failed" and client.get(f"/jobs/{job_id}").json()["status"] == "done":
+                break
+            time.sleep(0.1)
+        assert client.get(f"/jobs/{job_id}/result").json() == expected
+        assert client.get(f"/jobs/{failed_id}/result").status_code == 400
+        assert client.get("/jobs/not-a-job").status_code == 404
+
+def test_api_metrics(preproc):
+    import api
+    assert {'parse', 'setup', 'input_loop', 'basic_tables'} <= set(preproc.timings)
+
+    client = TestClient(app)
+    api.cache.clear()
+    client.post("/preprocess", params={"mxl_filepath": mxl_filepath})
+    text = client.get("/metrics").text
+    assert 'musetable_stage_duration_seconds_count{stage="parse"}' in text
+    assert 'musetable_stage_duration_seconds_bucket{stage="serialize",le="+Inf"}' in text
+    assert 'musetable_requests_total{method="POST",handler="preprocess",status="200"}' in text
+    assert 'musetable_notes_processed_total' in text and '# TYPE musetable_cache_misses_total counter' in text
+
+def test_api_profile(monkeypatch):
+    import api
+    client = TestClient(app)
+    params = {"mxl_filepath": mxl_filepath, "profile": True}
+    assert client.post("/preprocess", params=params).status_code == 403
+
+    monkeypatch.setattr(api, "PROFILING_ENABLED", True)
+    response = client.post("/preprocess", params=params).json()
+    assert response["data_dict"]["tracks"]["track_name"] == ["Pasta Piece"]
+    assert "parse" in response["timings"]
+    assert any("music21" in function["function"] for function in response["profile"]["functions"])
+
+def test_admission_control(monkeypatch):
+    import asyncio
+    import api
+    from admission import AdmissionController, AdmissionRejected, estimate_cost
+
+    with open(mxl_filepath, 'rb') as file:
+        mxl_bytes = file.read()
+    assert estimate_cost(mxl_bytes, comprehensive=True) == 4 * estimate_cost(mxl_bytes)
+
+    # an archive that can't be decompressed costs the minimum, and is a client error
+    import io
+    import zipfile
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('score.xml', b'<score-partwise>' + b'<measure number="1"/>' * 10000)
+    corrupted = bytearray(buffer.getvalue())
+    corrupted[40:60] = b'\xff' * 20
+    assert estimate_cost(bytes(corrupted)) == 1.0
+    assert TestClient(app).post("/preprocess/upload", content=bytes(corrupted)).status_code == 400
+
+    async def run_controller():
+        controller = AdmissionController(capacity=2, max_queue=1, queue_timeout=5)
+        assert await controller.acquire(5) == 2  # capped at capacity
+        waiting = asyncio.ensure_future(controller.acquire(1))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected):
+            await controller.acquire(1)  # the queue is full
+        controller.release(2)
+        assert await waiting == 1 and controller.in_flight == 1
+    asyncio.run(run_controller())
+
+    # a full server answers 429 with Retry-After
+    monkeypatch.setattr(api, "admission", AdmissionController(capacity=1, max_queue=0))
+    api.admission.in_flight = 1
+    api.cache.clear()
+    response = TestClient(app).post("/preprocess", params={"mxl_filepath": mxl_filepath})
+    assert response.status_code == 429 and int(response.headers["retry-after"]) >= 1
+    assert 'musetable_admission_rejected_total{reason="queue_full"}' in TestClient(app).get("/metrics").text
+
+def test_api_stream():
+    import json
+    import api
+    client = TestClient(app)
+    api.cache.clear()
+    expected = client.post("/preprocess", params={"mxl_filepath": mxl_filepath, "comprehensive": True}).json()
+    api.cache.clear()
+
+    params = {"mxl_filepath": mxl_filepath, "comprehensive": True}
+    response = client.post("/preprocess/stream", params=params)
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = []
+    for block in response.text.strip().split("\n\n"):
+        event_line, data_line = block.split("\n")
+        events.append((event_line[len("event: "):], json.loads(data_line[len("data: "):])))
+    names = [event for event, _ in events]
+
+    # basic tables arrive before the comprehensive stages finish, and match /preprocess
+    assert names.index("table") < names.index("stage", names.index("table"))
+    assert any(event == "progress" for event in names)
+    tables = {data["table"]: data["columns"] for event, data in events if event == "table"}
+    assert tables == expected
+    assert events[-1][0] == "done" and events[-1][1]["validation_message"] == "all values validated!"
+
+    # a file the parser fails on ends the stream with an error event
+    params = {"mxl_filepath": os.path.join(ROOT_DIR, 'data', 'Free - Verse.mxl')}
+    last_block = client.post("/preprocess/stream", params=params).text.strip().split("\n\n")[-1]
+    assert last_block.startswith("event: error") and '"status_code":500' in last_block.replace(" ", "")
+
+    params["columns"] = ["notes.not_a_column"]
+    assert client.post("/preprocess/stream", params=params).status_code == 400
@@ -0,0 +1,138 @@
+import hashlib
+from fractions import Fraction
+
+import pytest
+
+from musetable_db import ingest
+from musetable_db.const import TABLE_NAMES
+from musetable_db.insert import format_field_text, checksum_columns, get_table_columns, make_copy_buffer, verify_section
+from musetable_db.preprocess import get_table_position
+
+# value: text of the field in row::text, as output by Postgres
+FIELD_TEXTS = [
+    (1/3, '0.3333333333333333'),
+    (0.5, '0.5'),
+    (4.0, '4'),
+    (-0.25, '-0.25'),
+    (1e-05, '1e-05'),
+    (1e15, '1e+15'),
+    (1e16, '1e+16'),
+    (Fraction(2, 3), '0.6666666666666666'),
+    (float('nan'), 'NaN'),
+    (12, '12'),
+    ('C', 'C'),
+    ('Perfect Unison', '"Perfect Unison"'),
+    ('a,b', '"a,b"'),
+    ('(a)', '"(a)"'),
+    ('say "hi"', '"say ""hi"""'),
+    ('back\\slash', '"back\\\\slash"'),
+    ('', '""'),
+    (None, ''),
+]
+
+@pytest.mark.parametrize("value, text", FIELD_TEXTS)
+def test_format_field_text(value, text):
+    assert format_field_text(value) == text
+
+def md5_bigint(row_text):
+    "('x' || left(md5(row_text), 16))::bit(64)::bigint"
+    number = int(hashlib.md5(row_text.encode('utf-8')).hexdigest()[:16], 16)
+    return number - 2**64 if number >= 2**63 else number
+
+def test_checksum_columns():
+    columns = [[1, 2], ['a b', 'c'], [0.5, None]]
+    row_texts = ['(1,"a b",0.5)', '(2,c,)']
+
+    assert checksum_columns(columns) == (2, sum(md5_bigint(row_text) for row_text in row_texts))
+
+    # order of the rows doesn't matter, their values do
+    assert checksum_columns([column[::-1] for column in columns]) == checksum_columns(columns)
+    assert checksum_columns([[1, 2], ['a b', 'c'], [0.5, 1.0]]) != checksum_columns(columns)
+
+    assert checksum_columns([[], []]) == (0, 0)
+
+class FakeCursor:
+    "Returns the checksums of the given tables, and records the statements it runs"
+
+    def __init__(self, server_version, tables_columns):
+        self.connection = type('FakeConnection', (), {'server_version': server_version})()
+        self.tables_columns = tables_columns
+        self.statements = []
+
+    def execute(self, query, params=None):
+        self.statements.append(query)
+
+    def fetchall(self):
+        return [(table_name, *checksum_columns(columns)) for table_name, columns in self.tables_columns.items()]
+
+def test_verify_section():
+    table_names = ['tracks', 'sections']
+    tables_dict = {'tracks': ['id', 'tempo'], 'sections': ['id', 'track_id']}
+    data_dicts = ({'id': 't', 'tempo': 1/3}, {'id': 's', 'track_id': 't'})
+    tables_columns = {'tracks': [['t'], [1/3]], 'sections': [['s'], ['t']]}
+
+    cursor = FakeCursor(150000, tables_columns)
+    assert verify_section(cursor, table_names, tables_dict, data_dicts) == []
+    # floats are output the way format_field_text expects before anything is checksummed
+    assert cursor.statements[0] == "SET LOCAL extra_float_digits = 1;"
+
+    changed_dicts = ({'id': 't', 'tempo': 0.5}, data_dicts[1])
+    assert verify_section(FakeCursor(150000, tables_columns), table_names, tables_dict, changed_dicts) == ['tracks']
+
+    # older servers output floats differently, so every checksum would mismatch
+    with pytest.raises(RuntimeError):
+        verify_section(FakeCursor(110000, tables_columns), table_names, tables_dict, data_dicts)
+
+def test_get_table_columns():
+    # rows of tracks and sections are single values, the other tables hold columns
+    assert get_table_columns({'id': 'x', 'name': 'y', 'extra': 1}, ['name', 'id']) == [['y'], ['x']]
+    assert get_table_columns({'a': [1, 2], 'b': [3, 4]}, ['b', 'a']) == [[3, 4], [1, 2]]
+
+def test_make_copy_buffer():
+    # an unquoted empty field is an empty string, as COPY reads NULL as \N
+    buffer = make_copy_buffer([[1, 2], ['a,b', ''], [Fraction(1, 2), None]])
+    assert buffer.read() == '1,"a,b",0.5\n2,,\\N\n'
+
+def test_get_table_position():
+    assert [get_table_position(table_name) for table_name in TABLE_NAMES] == list(range(len(TABLE_NAMES)))
+    assert get_table_position('other') == len(TABLE_NAMES)
+
+class FakeDatabaseControl:
+    "Records which indexes were dropped instead of connecting"
+    dropped = None
+
+    def without_indexes(self, indexes=None, load_indexes=None):
+        FakeDatabaseControl.dropped = (list(indexes), list(load_indexes))
+        return ingest.contextlib.nullcontext()
+
+@pytest.fixture
+def ingest_calls(monkeypatch):
+    calls = []
+    FakeDatabaseControl.dropped = None
+    monkeypatch.setattr(ingest, 'DatabaseControl', FakeDatabaseControl)
+    monkeypatch.setattr(ingest, 'ingest', lambda *args: calls.append(args) or {})
+    return calls
+
+def test_main_ingest(ingest_calls):
+    assert ingest.main(['ingest', 'a.mxl', 'b.mxl', '--workers', '0', '--playlist', 'p.csv']) == 0
+    assert ingest_calls == [(['a.mxl', 'b.mxl'], 'p.csv', 1)]
+    assert FakeDatabaseControl.dropped is None
+
+    assert ingest.main(['ingest', 'a.mxl', '--drop-indexes']) == 0
+    assert ingest_calls[1][0] == ['a.mxl']
+    # the loads delete and verify rows by section_id, so notes gets a plain section_id index in place of its composite
+    assert FakeDatabaseControl.dropped == (
+        ['sections_track_id_idx', 'notes_section_id_offset_ql_idx'],
+        ['notes_section_id_load_idx'],
+    )
+
+def test_main_ingest_failures(monkeypatch, ingest_calls):
+    monkeypatch.setattr(ingest, 'ingest', lambda *args: {'a.mxl': 'error'})
+    assert ingest.main(['ingest', 'a.mxl']) == 1
+
+def test_main_arguments(ingest_calls):
+    with pytest.raises(SystemExit):
+        ingest.main([])
+    with pytest.raises(SystemExit):
+        ingest.main(['ingest'])
+    assert ingest_calls == []